@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+An asyncio INDI client.
+
+A single task reads from the server and decodes the stream, the
+messages can then be consumed with 'async for', or waited for
+with waitFor() / waitForProperty(). This means that one event loop
+can handle many clients (and devices) without any polling.
+
+Usage:
+
+async with AsyncIndiClient("localhost", 7624) as client:
+    client.send(indiXML.clientGetProperties(indi_attr = {"version" : "1.7"}))
+    async for message in client:
+        print(message)
+"""
+
+import asyncio
+
+import indi_python.indi_stream as indiStream
+import indi_python.indi_xml as indiXML
+
+
+class AsyncIndiClientException(Exception):
+    pass
+
+
+class AsyncIndiClient(object):
+
+    def __init__(self, ip_address, port = 7624, read_size = 2**20, max_queue = 0, high_water_mark = 2**24,
+                 lazy_blobs = False, max_message_size = None, overflow = "raise",
+                 stream_blobs = False, blob_spill_size = None, blob_directory = None, **kwds):
+        """
+        read_size - The maximum number of bytes to read at a time.
+
+        max_queue - The maximum number of messages waiting to be iterated
+            over, 0 for no limit. When the queue is full we stop reading
+            from the server. Messages are only queued while there is an
+            'async for' over the client, so a client that only uses
+            waitFor() doesn't keep every message.
+
+        high_water_mark - When there are more than this many bytes waiting
+            to be sent drain() waits for them to be written.
+
+        The other arguments are the same as for BasicIndiClient.
+        """
+        super().__init__(**kwds)
+        self.consumers = 0
+        self.error = None
+        self.high_water_mark = high_water_mark
+        self.ip_address = ip_address
+        self.port = port
+        self.property_store = None
+        self.queue = asyncio.Queue(maxsize = max_queue)
+        self.read_size = read_size
+        self.reader = None
+        self.reader_task = None
+        self.send_buffer = bytearray()
+        self.waiters = []
+        self.writer = None
+
+        self.decoder = indiStream.INDIStreamDecoder(blob_directory = blob_directory,
+                                                    blob_spill_size = blob_spill_size,
+                                                    lazy_blobs = lazy_blobs,
+                                                    max_message_size = max_message_size,
+                                                    overflow = overflow,
+                                                    stream_blobs = stream_blobs)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __aiter__(self):
+        return self.iterMessages()
+
+    def clearQueue(self):
+        """
+        Drop the queued messages, keeping the end of iteration marker.
+        """
+        closed = False
+        while not self.queue.empty():
+            if self.queue.get_nowait() is None:
+                closed = True
+        if closed:
+            self.queue.put_nowait(None)
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    async def connect(self):
+        [self.reader, self.writer] = await asyncio.open_connection(self.ip_address, self.port)
+        self.writer.transport.set_write_buffer_limits(high = self.high_water_mark)
+        self.reader_task = asyncio.ensure_future(self.readMessages())
+
+    async def drain(self):
+        """
+        Wait until the outgoing data is below the high water mark.
+        """
+        await self.writer.drain()
+
+    def finished(self, error = None):
+        """
+        Called when the connection is closed, error is the exception
+        that stopped the reader, if any.
+        """
+        self.error = error
+        self.decoder.abortBLOBs()
+
+        if error is None:
+            error = AsyncIndiClientException("Connection to " + self.ip_address + " closed.")
+        for [predicate, future] in self.waiters:
+            if not future.done():
+                future.set_exception(error)
+        self.waiters = []
+
+        # The end of iteration marker, the queue may be full.
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+    async def iterMessages(self):
+        """
+        Yields the messages, the iteration stops when the connection to
+        the server is closed. Messages are queued while this is running.
+        """
+        self.consumers += 1
+        try:
+            while True:
+                message = await self.queue.get()
+                if message is None:
+                    # Leave the marker for any other consumers.
+                    self.queue.put_nowait(None)
+                    if self.error is not None:
+                        raise self.error
+                    return
+                yield message
+
+        finally:
+            # Nobody is iterating, so nobody will take these.
+            self.consumers -= 1
+            if (self.consumers == 0):
+                self.clearQueue()
+
+    def processMessages(self, messages):
+        if self.property_store is not None:
+            self.property_store.applyMessages(messages)
+
+        if self.waiters:
+            for message in messages:
+                waiters = []
+                for [predicate, future] in self.waiters:
+                    if future.done():
+                        continue
+                    if predicate(message):
+                        future.set_result(message)
+                    else:
+                        waiters.append([predicate, future])
+                self.waiters = waiters
+
+    async def readMessages(self):
+        """
+        The reader task.
+        """
+        error = None
+        try:
+            while True:
+                data = await self.reader.read(self.read_size)
+                if not data:
+                    break
+
+                messages = self.decoder.feed(data)
+                self.processMessages(messages)
+                for message in messages:
+                    if (self.consumers == 0):
+                        break
+                    await self.queue.put(message)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            error = exception
+        finally:
+            self.finished(error)
+
+    def send(self, indi_elt):
+        self.sendMessages([indi_elt])
+
+    def sendMessages(self, indi_elts):
+        """
+        Queue several messages for sending, this does not block. Use
+        drain() to wait for them to be sent.
+        """
+        if self.writer is None:
+            raise AsyncIndiClientException("Not connected.")
+
+        del self.send_buffer[:]
+        for indi_elt in indi_elts:
+            indi_elt.writeXML(self.send_buffer)
+            self.send_buffer += b'\n'
+        self.writer.write(bytes(self.send_buffer))
+
+    def setDevice(self, device = None):
+        """
+        Only return messages from this device, None for all devices.
+        """
+        self.decoder.setDevice(device)
+
+    def setPropertyStore(self, property_store = None):
+        """
+        Keep property_store (a PropertyStore) up to date with all the
+        messages that we receive.
+        """
+        self.property_store = property_store
+
+    def subscribe(self, callback, device = None, name = None, etype = None):
+        """
+        Subscribe to messages, see INDIStreamDecoder.subscribe(). Once there
+        are subscriptions only the messages that match them are returned.
+        """
+        self.decoder.subscribe(callback, device = device, name = name, etype = etype)
+
+    def unsubscribe(self, callback, device = None, name = None, etype = None):
+        self.decoder.unsubscribe(callback, device = device, name = name, etype = etype)
+
+    async def waitFor(self, predicate, timeout = None):
+        """
+        Returns the next message for which predicate(message) is True. This
+        raises asyncio.TimeoutError if there is no such message in timeout
+        seconds.
+        """
+        if self.reader_task is None or self.reader_task.done():
+            raise AsyncIndiClientException("Not connected.")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append([predicate, future])
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters = [x for x in self.waiters if not (x[1] is future)]
+
+    async def waitForProperty(self, device, name, state = None, timeout = None):
+        """
+        Returns the next def or set message for this property, or the next
+        one with this state (such as "Ok") if state is not None.
+        """
+        def predicate(message):
+            if not isinstance(message, indiXML.INDIVector):
+                return False
+            if not (message.etype.startswith("def") or message.etype.startswith("set")):
+                return False
+            if (message.getAttr("device") != device) or (message.getAttr("name") != name):
+                return False
+            return (state is None) or (message.hasAttr("state") and (message.getAttr("state") == state))
+
+        return await self.waitFor(predicate, timeout = timeout)
+
+
+if (__name__ == "__main__"):
+
+    #
+    # A test against a fake INDI server on the loopback interface.
+    #
+    async def fakeServer(reader, writer):
+        """
+        Defines a property, then answers each newNumberVector with a Busy
+        and then an Ok setNumberVector.
+        """
+        vector = indiXML.defNumberVector([indiXML.defNumber(0.0, indi_attr = {"name" : "VALUE",
+                                                                                "iformat" : "%g",
+                                                                                "imin" : 0,
+                                                                                "imax" : 100,
+                                                                                "step" : 1})],
+                                         indi_attr = {"device" : "Fake Device",
+                                                      "name" : "FAKE_PROPERTY",
+                                                      "perm" : "rw",
+                                                      "state" : "Idle"})
+        writer.write(vector.toXML() + b'\n')
+
+        decoder = indiStream.INDIStreamDecoder()
+        while True:
+            data = await reader.read(2**16)
+            if not data:
+                break
+            for message in decoder.feed(data):
+                if not isinstance(message, indiXML.NewNumberVector):
+                    continue
+                value = message.getElt(0).getValue()
+                for state in ["Busy", "Ok"]:
+                    reply = indiXML.setNumberVector([indiXML.oneNumber(value, indi_attr = {"name" : "VALUE"})],
+                                                    indi_attr = {"device" : "Fake Device",
+                                                                 "name" : "FAKE_PROPERTY",
+                                                                 "state" : state})
+                    writer.write(reply.toXML() + b'\n')
+                    await writer.drain()
+                    await asyncio.sleep(0.05)
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(fakeServer, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async with AsyncIndiClient("127.0.0.1", port) as client:
+            client.send(indiXML.clientGetProperties(indi_attr = {"version" : "1.7"}))
+            message = await client.waitForProperty("Fake Device", "FAKE_PROPERTY", timeout = 1.0)
+            print("defined", message.getAttr("name"), message.getElt(0).getValue())
+
+            for value in [1.0, 2.5, 10.0]:
+                client.send(indiXML.newNumberVector([indiXML.oneNumber(value, indi_attr = {"name" : "VALUE"})],
+                                                    indi_attr = {"device" : "Fake Device",
+                                                                 "name" : "FAKE_PROPERTY"}))
+                message = await client.waitForProperty("Fake Device", "FAKE_PROPERTY", state = "Ok", timeout = 1.0)
+                assert (message.getElt(0).getValue() == value)
+                print("set", value, message.getAttr("state"))
+
+            try:
+                await client.waitForProperty("Fake Device", "NO_PROPERTY", timeout = 0.2)
+            except asyncio.TimeoutError:
+                print("timed out as expected")
+
+        # Iterate over the messages.
+        async with AsyncIndiClient("127.0.0.1", port) as client:
+            async for message in client:
+                print("iterated", message.etype, message.getAttr("name"))
+                break
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
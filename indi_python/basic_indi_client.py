@@ -6,87 +6,707 @@ Hazen 02/17
 """
 
 import argparse
+import queue
+import selectors
 import socket
 import sys
+import threading
 import time
-from xml.etree import ElementTree
 
+import indi_python.indi_stream as indiStream
 import indi_python.indi_xml as indiXML
+import indi_python.send_queue as sendQueue
+import indi_python.session as session
+
+
+class BasicIndiClientException(Exception):
+    pass
+
+
+class BasicIndiChannel(object):
+    """
+    A single connection to the server, with its own decoder, send
+    path and statistics.
+    """
+    def __init__(self, name = None, decoder = None, **kwds):
+        super().__init__(**kwds)
+        self.a_socket = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.decoder = decoder
+        self.messages_received = 0
+        self.name = name
+        self.send_buffer = bytearray()
+        self.send_lock = threading.Lock()
+        self.send_queue = None
+        self.sending = False
+        self.writer_thread = None
+
+    def close(self):
+        if self.a_socket is not None:
+            self.a_socket.close()
+            self.a_socket = None
+
+    def connect(self, address, timeout):
+        self.a_socket = socket.create_connection(address, timeout = timeout)
+
+        # A socket timeout limits the whole of sendall(), which would leave
+        # part of a message on the wire. Reads go through the selector, so
+        # they don't need a timeout either.
+        self.a_socket.settimeout(None)
+
+        # Don't delay small control messages, we do our own coalescing.
+        self.a_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def getStats(self):
+        stats = {"bytes_received" : self.bytes_received,
+                 "bytes_sent" : self.bytes_sent,
+                 "messages_received" : self.messages_received,
+                 "bytes_queued" : 0}
+        if self.send_queue is not None:
+            stats["bytes_queued"] = self.send_queue.getSize()
+        return stats
+
+    def sendAll(self, data):
+        """
+        sendall() doesn't return until all the data is written. If it fails
+        part of a message may have been sent, so the stream is corrupt and
+        we shutdown the socket. The reader then sees the connection close.
+        """
+        try:
+            self.a_socket.sendall(data)
+        except OSError:
+            self.shutdown()
+            raise
+        self.bytes_sent += len(data)
+
+    def sendData(self, data):
+        with self.send_lock:
+            if self.a_socket is None:
+                raise BasicIndiClientException("Socket is not connected.")
+            self.sendAll(data)
+
+    def shutdown(self):
+        """
+        Wakes up a thread that is waiting on the socket.
+        """
+        try:
+            self.a_socket.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+    def writeMessages(self, indi_elts):
+        """
+        Send several messages with a single write.
+        """
+        with self.send_lock:
+            if self.a_socket is None:
+                raise BasicIndiClientException("Socket is not connected.")
+            del self.send_buffer[:]
+            for indi_elt in indi_elts:
+                indi_elt.writeXML(self.send_buffer)
+                self.send_buffer += b'\n'
+            self.sendAll(self.send_buffer)
 
 
 class BasicIndiClient(object):
 
-    def __init__(self, ip_address, port, timeout = 0.5):
-        socket.setdefaulttimeout(timeout)
+    def __init__(self, ip_address, port, timeout = 0.5, buffer_size = 2**20,
+                 lazy_blobs = False, max_message_size = None, overflow = "raise",
+                 stream_blobs = False, blob_spill_size = None, blob_directory = None,
+                 threaded = False, max_queue = 1000,
+                 reconnect = False, backoff = None, resync_timeout = 5.0,
+                 send_queue = False, high_water_mark = 2**24, send_policy = "block",
+                 blob_channel = False):
+        """
+        timeout - The default time to wait for messages in getMessages(),
+            and the timeout for connecting. Sends block until all the data
+            is written.
+
+        buffer_size - The size of the (reused) receive buffer in bytes.
+
+        lazy_blobs - Only decode BLOBs when their value is requested.
+
+        max_message_size, overflow - The largest message we will accept,
+            and what to do with larger ones, see INDIStreamDecoder.
+
+        stream_blobs, blob_spill_size, blob_directory - Decode BLOBs as
+            they arrive, spilling large ones to disk, see INDIStreamDecoder.
+
+        threaded - Read and decode the socket continuously in a separate
+            thread, putting the messages in a queue. The queue can be
+            shared by several consumer threads, see getMessage(). Note
+            that the property store and any subscription callbacks are
+            then updated / called in the reader thread.
+
+        max_queue - The maximum number of messages in the queue in
+            threaded mode. When the queue is full the reader thread
+            waits for it to empty.
+
+        reconnect - If the connection is lost, reconnect with exponential
+            backoff (a session.Backoff) and replay the getProperties and
+            enableBLOB messages that were sent. See session.Session for
+            how the property store is resynchronized, resync_timeout is
+            how long to wait for the properties to be defined again.
+
+        send_queue - Queue outgoing messages and send them from a separate
+            thread, so sendMessages() doesn't wait for the socket. Control
+            messages are sent before any queued BLOB uploads, see
+            send_queue.SendQueue.
+
+        high_water_mark, send_policy - When there are more than this many
+            bytes in the send queue, BLOB uploads either "block" until there
+            is space or "raise" BasicIndiClientException.
+
+        blob_channel - Use a second connection for BLOBs, so that a large
+            image never holds up the control messages. enableBLOB is sent
+            as "Never" on the control connection and "Only" on the BLOB
+            connection, getProperties is sent on both and BLOB uploads go
+            on the BLOB connection. Only setBLOBVector messages are kept
+            from the BLOB connection, the rest duplicate the control
+            connection. The messages from both connections are returned
+            together, see also getChannelStats().
+        """
+        if not send_policy in ["block", "raise"]:
+            raise BasicIndiClientException("Unknown send policy '" + str(send_policy) + "'.")
+
+        self.address = (ip_address, port)
+        self.auto_reconnect = reconnect
+        self.backoff = backoff
+        self.error = None
+        self.queue = None
+        self.reader_thread = None
+        self.send_condition = threading.Condition()
+        self.send_error = None
+        self.send_policy = send_policy
+        self.stop_event = threading.Event()
+        self.session = session.Session(resync_timeout = resync_timeout)
+        self.timeout = timeout
 
-        self.a_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.a_socket.connect((ip_address, port))
+        if self.backoff is None:
+            self.backoff = session.Backoff()
 
-        self.device = None
-        self.message_string = None
+        def makeDecoder(etypes = None):
+            return indiStream.INDIStreamDecoder(blob_directory = blob_directory,
+                                                blob_spill_size = blob_spill_size,
+                                                etypes = etypes,
+                                                lazy_blobs = lazy_blobs,
+                                                max_message_size = max_message_size,
+                                                overflow = overflow,
+                                                stream_blobs = stream_blobs)
+
+        self.control = BasicIndiChannel(name = "control", decoder = makeDecoder())
+        self.channels = [self.control]
+        self.blob = None
+        if blob_channel:
+            # The BLOB connection also gets the definitions and any messages
+            # sent before enableBLOB, these already come on the control
+            # connection so they are skipped without being decoded.
+            self.blob = BasicIndiChannel(name = "blob", decoder = makeDecoder(etypes = ["setBLOBVector"]))
+            self.channels.append(self.blob)
+        self.decoder = self.control.decoder
+
+        # We only read when the selector says that there is data, so
+        # reads never wait for the socket timeout.
+        self.selector = selectors.DefaultSelector()
+        self.connectSockets()
+
+        self.buffer = bytearray(buffer_size)
+        self.buffer_view = memoryview(self.buffer)
+        self.connected = True
+        self.pending = []
+        self.pending_index = 0
+        self.property_store = None
+
+        if threaded:
+            self.queue = queue.Queue(maxsize = max_queue)
+            self.reader_thread = threading.Thread(target = self.readerThread, daemon = True)
+            self.reader_thread.start()
+
+        if send_queue:
+            for channel in self.channels:
+                channel.send_queue = sendQueue.SendQueue(high_water_mark = high_water_mark)
+                channel.writer_thread = threading.Thread(target = self.writerThread, args = (channel,), daemon = True)
+                channel.writer_thread.start()
 
     def close(self):
-        self.a_socket.close()
+        # Send anything that is still queued.
+        if self.control.writer_thread is not None:
+            self.flush()
+            with self.send_condition:
+                self.stop_event.set()
+                self.send_condition.notify_all()
+            for channel in self.channels:
+                channel.writer_thread.join()
+                channel.writer_thread = None
+
+        self.stop_event.set()
+        if self.reader_thread is not None:
+
+            # This wakes the reader thread if it is waiting for data.
+            for channel in self.channels:
+                channel.shutdown()
+            self.reader_thread.join()
+            self.reader_thread = None
+
+            # Wake any consumers that are still waiting.
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+        self.selector.close()
+        for channel in self.channels:
+            channel.close()
 
-    def getMessages(self):
+    def closeSockets(self):
+        for channel in self.channels:
+            if channel.a_socket is not None:
+                self.selector.unregister(channel.a_socket)
+                channel.close()
+
+    def connectSockets(self):
+        for channel in self.channels:
+            channel.connect(self.address, self.timeout)
+            self.selector.register(channel.a_socket, selectors.EVENT_READ, channel)
+
+    def flush(self, timeout = None):
+        """
+        Wait (up to timeout seconds) until everything in the send queue
+        has been sent. Returns False if this timed out.
         """
-        This will return 'None' if there were no messages, or no complete 
-        messages. The expectation is that this will then be called again 
+        if self.control.send_queue is None:
+            return True
+
+        def sent():
+            for channel in self.channels:
+                if channel.sending or not channel.send_queue.isEmpty():
+                    return False
+            return True
+
+        with self.send_condition:
+            return self.send_condition.wait_for(sent, timeout)
+
+    def getChannelStats(self):
+        """
+        Returns a dictionary of statistics for each connection, "control"
+        and (if there is one) "blob".
+        """
+        return {x.name : x.getStats() for x in self.channels}
+
+    def getMessage(self, block = True, timeout = None):
+        """
+        Threaded mode only, returns the next message from the queue. This
+        is safe to call from several threads.
+
+        Returns None if there is no message (after waiting up to timeout
+        seconds if block is True), or the connection is closed.
+        """
+        try:
+            message = self.queue.get(block, timeout)
+        except queue.Empty:
+            return None
+
+        # Put the end of stream marker back for the other consumers.
+        if message is None:
+            self.queue.put_nowait(None)
+            if self.error is not None:
+                raise self.error
+        return message
+
+    def getMessages(self, timeout = None):
+        """
+        Returns the messages that have arrived, waiting up to timeout
+        seconds (the client timeout by default) for some data.
+
+        This will return 'None' if there were no messages, or no complete
+        messages. The expectation is that this will then be called again
         after some timeout to get the rest of message.
         """
-        # Add starting tag if this is a new message.
-        if self.message_string is None:
-            self.message_string = "<data>"
+        if timeout is None:
+            timeout = self.timeout
+
+        new_messages = self.pending + self.readMessages(timeout)
+        self.pending = []
+        self.pending_index = 0
+
+        # Wait for the rest of the message.
+        if not new_messages and (self.queue is None) and any(x.decoder.hasPartialMessage() for x in self.channels):
+            return None
+
+        return new_messages
+
+    def getReconnectStats(self):
+        """
+        See session.Session.getStats().
+        """
+        return self.session.getStats()
+
+    def handleDisconnect(self):
+        """
+        Returns True if we were able to reconnect.
+        """
+        self.session.disconnected()
+        for channel in self.channels:
+            channel.decoder.reset()
+        self.closeSockets()
 
-        # Get as much data as we can from the socket.
+        if self.auto_reconnect:
+            self.backoff.reset()
+            delay = self.backoff.nextDelay()
+            while (delay is not None) and not self.stop_event.wait(delay):
+                delay = self.backoff.nextDelay()
+                try:
+                    self.connectSockets()
+
+                    # Ask for the same properties (and BLOBs) as before.
+                    for [channel, indi_elts] in self.routeMessages(self.session.getReplay()):
+                        channel.writeMessages(indi_elts)
+                    self.session.reconnected(self.property_store)
+                    self.send_error = None
+
+                except OSError:
+                    self.closeSockets()
+                    continue
+
+                return True
+
+        self.connected = False
+        return False
+
+    def isReady(self):
+        """
+        False while we are resynchronizing after a reconnect.
+        """
+        return self.session.isReady()
+
+    def processMessages(self, new_messages):
+        if self.property_store is not None:
+            self.property_store.applyMessages(new_messages)
+        if not self.session.apply(new_messages):
+            self.session.checkTimeout()
+
+    def putMessage(self, message):
+        """
+        Called by the reader thread, returns False if we were stopped
+        while waiting for space in the queue.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(message, timeout = self.timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def queueDepth(self):
+        """
+        The number of messages waiting in the queue in threaded mode.
+        """
+        if self.queue is None:
+            return 0
+        return self.queue.qsize()
+
+    def queueMessages(self, indi_elts):
+        indi_elts = list(indi_elts)
+        routes = self.routeMessages(indi_elts)
+        with self.send_condition:
+            if self.send_error is not None:
+                error = self.send_error
+                self.send_error = None
+                raise error
+
+            # Only BLOB uploads wait for space, so that control messages
+            # such as aborts are never held up by them.
+            upload_channel = self.control if (self.blob is None) else self.blob
+            uploads = any(isinstance(x, indiXML.NewBLOBVector) for x in indi_elts)
+            if uploads and upload_channel.send_queue.isFull():
+                if (self.send_policy == "raise"):
+                    raise BasicIndiClientException("Send queue is full, " + str(upload_channel.send_queue.getSize()) + " bytes.")
+                self.send_condition.wait_for(lambda: not upload_channel.send_queue.isFull())
+
+            for indi_elt in indi_elts:
+                self.session.record(indi_elt)
+            for [channel, channel_elts] in routes:
+                channel.send_queue.put(channel_elts)
+            self.send_condition.notify_all()
+
+    def readerThread(self):
         try:
-            while True:
-                response = self.a_socket.recv(2**20)
-                self.message_string += response.decode("latin1")
-        except socket.timeout:
+            while not self.stop_event.is_set():
+                events = self.selector.select(self.timeout)
+                if not events:
+                    self.session.checkTimeout()
+                    continue
+
+                for [key, mask] in events:
+                    new_messages = self.recvMessages(key)
+                    if new_messages is None:
+                        return
+                    for message in new_messages:
+                        if not self.putMessage(message):
+                            return
+
+        except OSError:
+            # The socket was shutdown by close().
             pass
+        except Exception as exception:
+            self.error = exception
+        finally:
+            self.connected = False
+            for channel in self.channels:
+                channel.decoder.abortBLOBs()
+            self.putMessage(None)
+
+    def readMessages(self, timeout):
+        """
+        Wait up to timeout seconds (None is forever) for data to arrive,
+        then read everything that is available. Returns the messages
+        that were completed.
+        """
+        # In threaded mode the messages are already decoded.
+        if self.queue is not None:
+            new_messages = []
+            message = self.getMessage(timeout = timeout)
+            while message is not None:
+                new_messages.append(message)
+                message = self.getMessage(block = False)
+            return new_messages
+
+        # Get as much data as we can from the sockets, each chunk
+        # is only parsed once.
+        new_messages = []
+        while self.connected:
+            events = self.selector.select(timeout)
+            if not events:
+                break
+            for [key, mask] in events:
+                messages = self.recvMessages(key)
+                if messages is None:
+                    break
+                new_messages.extend(messages)
+            timeout = 0
+
+        self.session.checkTimeout()
+        return new_messages
+
+    def recvMessages(self, key):
+        """
+        Read and decode one chunk from a socket. Returns the messages
+        that were completed, or None if the connection was lost and we
+        could not reconnect.
+        """
+        channel = key.data
 
-        # Add closing tag.
-        self.message_string += "</data>"
+        # The socket was replaced by a reconnect.
+        if not (key.fileobj is channel.a_socket):
+            return []
 
-        # Try and parse the message.
-        messages = None
         try:
-            etree_messages = ElementTree.fromstring(self.message_string)
-            self.message_string = None
-            messages = []
-            for etree_message in etree_messages:
-                xml_message = indiXML.parseETree(etree_message)
-
-                # Filter message is self.device is not None.
-                if self.device is not None:
-                    if (self.device == xml_message.getAttr("device")):
-                        messages.append(xml_message)
-
-                # Otherwise just keep them all.
-                else:
-                    messages.append(xml_message)
+            n_bytes = channel.a_socket.recv_into(self.buffer)
+        except ConnectionError:
+            n_bytes = 0
 
-        # Reset if the message could not be parsed.
-        except ElementTree.ParseError:
-            self.message_string = self.message_string[:-len("</data>")]
+        if (n_bytes == 0):
+            if self.handleDisconnect():
+                return []
+            return None
 
-        return messages
+        new_messages = channel.decoder.feed(self.buffer_view[:n_bytes])
+        channel.bytes_received += n_bytes
+        channel.messages_received += len(new_messages)
+        self.processMessages(new_messages)
+        return new_messages
+
+    def routeMessages(self, indi_elts):
+        """
+        Returns a list of [channel, messages], the messages to send on
+        each connection.
+        """
+        if self.blob is None:
+            return [[self.control, indi_elts]]
+
+        control_elts = []
+        blob_elts = []
+        for indi_elt in indi_elts:
+            if isinstance(indi_elt, indiXML.GetProperties):
+                control_elts.append(indi_elt)
+                blob_elts.append(indi_elt)
+            elif isinstance(indi_elt, indiXML.EnableBLOB):
+                control_elts.append(indiXML.enableBLOB("Never", indi_attr = indi_elt.attr))
+                if (indi_elt.getValue() == "Never"):
+                    blob_elts.append(indi_elt)
+                else:
+                    blob_elts.append(indiXML.enableBLOB("Only", indi_attr = indi_elt.attr))
+            elif isinstance(indi_elt, indiXML.NewBLOBVector):
+                blob_elts.append(indi_elt)
+            else:
+                control_elts.append(indi_elt)
+
+        return [x for x in [[self.control, control_elts], [self.blob, blob_elts]] if x[1]]
 
     def sendMessage(self, indi_elt):
-        self.a_socket.send(indi_elt.toXML() + b'\n')
+        self.sendMessages([indi_elt])
+
+    def sendMessages(self, indi_elts):
+        """
+        Send several messages with a single write. With a send queue this
+        only queues the messages, any error from sending the previous
+        messages is raised here. indi_elts can be any iterable.
+        """
+        indi_elts = list(indi_elts)
+        if self.control.send_queue is not None:
+            self.queueMessages(indi_elts)
+            return
+
+        for indi_elt in indi_elts:
+            self.session.record(indi_elt)
+        for [channel, channel_elts] in self.routeMessages(indi_elts):
+            channel.writeMessages(channel_elts)
+
+    def sendQueueSize(self):
+        """
+        The number of bytes waiting in the send queue.
+        """
+        if self.control.send_queue is None:
+            return 0
+        return sum([x.send_queue.getSize() for x in self.channels])
 
     def setDevice(self, device = None):
-        self.device = device
-        
-    def waitMessages(self):
         """
-        This will block until all messages are recieved.
+        Only return messages from this device, None for all devices.
+        """
+        for channel in self.channels:
+            channel.decoder.setDevice(device)
+
+    def setPropertyStore(self, property_store = None):
+        """
+        Keep property_store (a PropertyStore) up to date with all the
+        messages that we receive.
+        """
+        self.property_store = property_store
 
-        FIXME: Add maximum wait time / attempts?
+    def subscribe(self, callback, device = None, name = None, etype = None):
+        """
+        Subscribe to messages, see INDIStreamDecoder.subscribe(). Once there
+        are subscriptions only the messages that match them are returned.
         """
+        for channel in self.channels:
+            channel.decoder.subscribe(callback, device = device, name = name, etype = etype)
+
+    def unsubscribe(self, callback, device = None, name = None, etype = None):
+        for channel in self.channels:
+            channel.decoder.unsubscribe(callback, device = device, name = name, etype = etype)
+
+    def waitFor(self, predicate, timeout = None, keep = False):
+        """
+        Returns the next message for which predicate(message) is True, or
+        None if there is no such message in timeout seconds (None is
+        forever). This returns as soon as the message arrives.
+
+        Messages that were received after the one that is returned are
+        returned by the next call to getMessages(), and are the first
+        that the next call to waitFor() looks at. If keep is True then
+        so are all the messages that were received while waiting,
+        including the one that is returned.
+        """
+        # Messages that arrived after an earlier match, pending_index is
+        # the first that waitFor() hasn't returned or gone past.
+        for i in range(self.pending_index, len(self.pending)):
+            message = self.pending[i]
+            if predicate(message):
+                if keep:
+                    self.pending_index = i + 1
+                else:
+                    del self.pending[i]
+                    self.pending_index = i
+                return message
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+
+            new_messages = self.readMessages(remaining)
+            for [i, message] in enumerate(new_messages):
+                if predicate(message):
+                    if keep:
+                        self.pending_index = len(self.pending) + i + 1
+                        self.pending.extend(new_messages)
+                    else:
+                        self.pending_index = len(self.pending)
+                        self.pending.extend(new_messages[i+1:])
+                    return message
+            if keep:
+                self.pending.extend(new_messages)
+
+            if not new_messages and not self.connected:
+                raise BasicIndiClientException("Connection closed.")
+
+            if (deadline is not None) and (time.monotonic() >= deadline):
+                return None
+
+    def waitForProperty(self, device, name, state = "Ok", timeout = None, keep = False):
+        """
+        Returns the next def or set message for this property with this
+        state, or any state if state is None. See waitFor().
+        """
+        def predicate(message):
+            if not isinstance(message, indiXML.INDIVector):
+                return False
+            if not (message.etype.startswith("def") or message.etype.startswith("set")):
+                return False
+            if (message.getAttr("device") != device) or (message.getAttr("name") != name):
+                return False
+            return (state is None) or (message.hasAttr("state") and (message.getAttr("state") == state))
+
+        return self.waitFor(predicate, timeout = timeout, keep = keep)
+
+    def waitMessages(self, timeout = None):
+        """
+        This will block until all the messages that we have started to
+        receive are complete, or timeout seconds (None is forever).
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
         messages = self.getMessages()
         while messages is None:
-            time.sleep(self.timeout)
-            messages = self.getMessages()
+            if not self.connected:
+                raise BasicIndiClientException("Connection closed.")
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0.0):
+                    return []
+            messages = self.getMessages(timeout = remaining)
         return messages
+
+    def writerThread(self, channel):
+        while True:
+            with self.send_condition:
+                self.send_condition.wait_for(lambda: self.stop_event.is_set() or not channel.send_queue.isEmpty())
+                data = channel.send_queue.next()
+                if data is None:
+                    break
+                channel.sending = True
+                self.send_condition.notify_all()
+
+            try:
+                channel.sendData(data)
+            except (BasicIndiClientException, OSError) as exception:
+                self.send_error = exception
+
+                # The socket was shutdown by sendData(), don't try to send
+                # the rest of the queue after a partial message.
+                with self.send_condition:
+                    channel.send_queue.clear()
+
+            with self.send_condition:
+                channel.sending = False
+                self.send_condition.notify_all()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Time the creation of every INDI command type using the original
+(spec scanning) constructor, the compiled constructor and the
+compiled constructor without validation.
+"""
+
+import argparse
+import time
+
+import indi_python.indi_xml as indiXML
+
+
+def legacyMakeObject(indi_type, fn_arg, fn_attr):
+    """
+    The original constructor, which walks the specification each time.
+    """
+    type_spec = indiXML.indi_spec[indi_type]
+    all_attr = []
+    final_attr = {}
+    for attr in type_spec["attributes"]:
+        attr_name = attr[0]
+        all_attr.append(attr_name)
+        if attr[2] and not attr_name in fn_attr:
+            raise indiXML.IndiXMLException(attr_name + " is a required attribute.")
+        if attr_name in fn_attr:
+            xml_name = attr[1]
+            if xml_name is None:
+                xml_name = attr[0]
+            final_attr[xml_name] = attr[3](fn_attr[attr_name])
+    for attr in fn_attr:
+        if not attr in all_attr:
+            raise indiXML.IndiXMLException(attr + " is not an attribute of " + indi_type + ".")
+    return type_spec["class"](type_spec.get("xml", indi_type), fn_arg, final_attr, None)
+
+def sampleValue(validator):
+    """
+    Returns a valid value for a validator function.
+    """
+    if (validator == indiXML.numberValue):
+        return 1.5
+    if (validator == indiXML.switchState):
+        return "On"
+    if (validator == indiXML.propertyState):
+        return "Ok"
+    if (validator == indiXML.listValue):
+        return []
+    return "value"
+
+def sampleArguments(indi_type):
+    """
+    Returns [arg, attributes] for an INDI command type, with all of
+    the attributes set.
+    """
+    type_spec = indiXML.indi_spec[indi_type]
+    arg = None
+    if "arg" in type_spec:
+        arg = sampleValue(type_spec["arg"])
+    attributes = {}
+    for attr in type_spec["attributes"]:
+        attributes[attr[0]] = sampleValue(attr[3])
+    return [arg, attributes]
+
+def timeIt(fn, repeats):
+    start_time = time.perf_counter()
+    for i in range(repeats):
+        fn()
+    return (time.perf_counter() - start_time)/repeats
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'INDI command constructor benchmark.')
+
+    parser.add_argument('--repeats', dest='repeats', type=int, required=False, default=20000,
+                        help = "The number of objects to create of each type.")
+
+    args = parser.parse_args()
+
+    print("{0:>20s} {1:>12s} {2:>12s} {3:>14s}".format("type", "legacy (us)", "checked (us)", "unchecked (us)"))
+    for indi_type in indiXML.indi_spec:
+        if not "attributes" in indiXML.indi_spec[indi_type]:
+            continue
+
+        [arg, attributes] = sampleArguments(indi_type)
+        ifunction = indiXML.makeINDIFn(indi_type)
+
+        legacy = timeIt(lambda: legacyMakeObject(indi_type, arg, attributes), args.repeats)
+        if "arg" in indiXML.indi_spec[indi_type]:
+            checked = timeIt(lambda: ifunction(arg, indi_attr = attributes), args.repeats)
+            unchecked = timeIt(lambda: ifunction.unchecked(arg, attributes), args.repeats)
+        else:
+            checked = timeIt(lambda: ifunction(indi_attr = attributes), args.repeats)
+            unchecked = timeIt(lambda: ifunction.unchecked(attributes), args.repeats)
+
+        print("{0:>20s} {1:12.2f} {2:12.2f} {3:14.2f}".format(indi_type, legacy * 1.0e6, checked * 1.0e6, unchecked * 1.0e6))
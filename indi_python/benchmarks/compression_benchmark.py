@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Compare raw (.fits) and zlib compressed (.fits.z) BLOBs, both the
+number of bytes on the wire and the end-to-end frame latency over a
+link with the given bandwidth.
+
+The latency is the time to compress the frame (done by the driver),
+plus the time to send the base64 encoded frame, plus the time to
+decode (and decompress) it with the INDIStreamDecoder.
+"""
+
+import argparse
+import base64
+import numpy
+import time
+import zlib
+
+import indi_python.indi_stream as indiStream
+
+
+def makeFITSFrame(size, sigma):
+    """
+    Returns a size x size 16 bit FITS image of a dark frame, which is
+    an offset plus Gaussian noise.
+    """
+    header = ""
+    for card in ["SIMPLE  =                    T",
+                 "BITPIX  =                   16",
+                 "NAXIS   =                    2",
+                 "NAXIS1  = {0:20d}".format(size),
+                 "NAXIS2  = {0:20d}".format(size),
+                 "BZERO   =                32768",
+                 "END"]:
+        header += "{0:80s}".format(card)
+    header += " " * (2880 - len(header) % 2880)
+
+    image = numpy.random.normal(loc = 1000.0, scale = sigma, size = (size, size))
+    image = (image - 32768).astype(numpy.dtype('>i2'))
+    return header.encode("ascii") + image.tobytes()
+
+def makeBLOBMessage(fits_data, blob_format, level):
+    """
+    Returns [message, compression time].
+    """
+    start_time = time.perf_counter()
+    payload = fits_data
+    if (blob_format == ".fits.z"):
+        payload = zlib.compress(fits_data, level)
+    compress_time = time.perf_counter() - start_time
+
+    payload = base64.standard_b64encode(payload).decode("ascii")
+    message = ('<setBLOBVector device="CCD Simulator" name="CCD1" state="Ok">\n' +
+               '<oneBLOB name="CCD1" size="' + str(len(fits_data)) + '" format="' + blob_format + '">\n' +
+               payload + '\n</oneBLOB>\n</setBLOBVector>\n').encode("ascii")
+    return [message, compress_time]
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'INDI BLOB compression benchmark.')
+
+    parser.add_argument('--bandwidth', dest='bandwidth', type=float, required=False, default=20.0,
+                        help = "The link bandwidth in Mbit/s.")
+    parser.add_argument('--level', dest='level', type=int, required=False, default=1,
+                        help = "The zlib compression level.")
+    parser.add_argument('--sigma', dest='sigma', type=float, required=False, default=10.0,
+                        help = "The noise in the frame, noisier frames compress less well.")
+    parser.add_argument('--size', dest='size', type=int, required=False, default=2048,
+                        help = "The frame size in pixels (size x size).")
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help = "Decode the BLOBs as they arrive.")
+
+    args = parser.parse_args()
+
+    fits_data = makeFITSFrame(args.size, args.sigma)
+    print("{0:>8s} {1:>10s} {2:>12s} {3:>10s} {4:>10s} {5:>10s} {6:>12s}".format("format", "frame (MB)", "wire (MB)",
+                                                                               "comp (s)", "wire (s)", "decode (s)",
+                                                                               "latency (s)"))
+    for blob_format in [".fits", ".fits.z"]:
+        [message, compress_time] = makeBLOBMessage(fits_data, blob_format, args.level)
+        wire_time = len(message) * 8.0/(args.bandwidth * 1.0e6)
+
+        start_time = time.perf_counter()
+        decoder = indiStream.INDIStreamDecoder(stream_blobs = args.stream)
+        messages = []
+        for i in range(0, len(message), 2**20):
+            messages.extend(decoder.feed(message[i:i+2**20]))
+        assert (len(messages[0].getElt(0).getValue()) == len(fits_data))
+        decode_time = time.perf_counter() - start_time
+
+        print("{0:>8s} {1:10.2f} {2:12.2f} {3:10.3f} {4:10.3f} {5:10.3f} {6:12.3f}".format(blob_format,
+                                                                                         len(fits_data)/2**20,
+                                                                                         len(message)/2**20,
+                                                                                         compress_time,
+                                                                                         wire_time,
+                                                                                         decode_time,
+                                                                                         compress_time + wire_time + decode_time))
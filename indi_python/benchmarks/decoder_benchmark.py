@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Compare the cost of decoding a setBLOBVector message that arrives in
+chunks, using the original 'reparse the whole buffer' approach and
+the incremental INDIStreamDecoder.
+"""
+
+import argparse
+import base64
+import os
+import time
+import tracemalloc
+from xml.etree import ElementTree
+
+import indi_python.indi_stream as indiStream
+import indi_python.indi_xml as indiXML
+
+
+def makeBLOBMessage(size):
+    """
+    Returns a setBLOBVector message with a random payload of size bytes.
+    """
+    payload = base64.standard_b64encode(os.urandom(size)).decode("ascii")
+    return ('<setBLOBVector device="CCD Simulator" name="CCD1" state="Ok">\n' +
+            '<oneBLOB name="CCD1" size="' + str(size) + '" format=".fits">\n' +
+            payload + '\n</oneBLOB>\n</setBLOBVector>\n').encode("ascii")
+
+def reparseDecode(chunks):
+    """
+    The original approach, re-parse everything after each chunk.
+    """
+    messages = []
+    message_string = "<data>"
+    for chunk in chunks:
+        message_string += chunk.decode("latin1") + "</data>"
+        try:
+            for etree in ElementTree.fromstring(message_string):
+                messages.append(indiXML.parseETree(etree))
+            message_string = "<data>"
+        except ElementTree.ParseError:
+            message_string = message_string[:-len("</data>")]
+    return messages
+
+def streamDecode(chunks, stream_blobs = False):
+    """
+    The incremental approach.
+    """
+    messages = []
+    decoder = indiStream.INDIStreamDecoder(stream_blobs = stream_blobs)
+    for chunk in chunks:
+        messages.extend(decoder.feed(chunk))
+    return messages
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'INDI stream decoder benchmark.')
+
+    parser.add_argument('--chunk', dest='chunk', type=int, required=False, default=2**20,
+                        help = "The size of the chunks the message arrives in (bytes).")
+    parser.add_argument('--max_size', dest='max_size', type=int, required=False, default=32,
+                        help = "The largest BLOB to test (MB).")
+
+    args = parser.parse_args()
+
+    print("{0:>10s} {1:>12s} {2:>12s} {3:>12s} {4:>10s} {5:>16s}".format("size (MB)", "reparse (s)", "stream (s)", "sink (s)",
+                                                                       "peak (MB)", "sink peak (MB)"))
+    size = 1
+    while (size <= args.max_size):
+        message = makeBLOBMessage(size * 2**20)
+        chunks = [message[i:i+args.chunk] for i in range(0, len(message), args.chunk)]
+
+        timings = []
+        for decodeFn in [reparseDecode, streamDecode, lambda x: streamDecode(x, stream_blobs = True)]:
+            start_time = time.perf_counter()
+            assert (len(decodeFn(chunks)) == 1)
+            timings.append(time.perf_counter() - start_time)
+
+        # Peak memory allocated while decoding, in addition to the chunks.
+        peaks = []
+        for stream_blobs in [False, True]:
+            tracemalloc.start()
+            streamDecode(chunks, stream_blobs = stream_blobs)
+            peaks.append(tracemalloc.get_traced_memory()[1]/2**20)
+            tracemalloc.stop()
+
+        print("{0:10d} {1:12.3f} {2:12.3f} {3:12.3f} {4:10.1f} {5:16.1f}".format(size, timings[0], timings[1], timings[2],
+                                                                                peaks[0], peaks[1]))
+        size = size * 2
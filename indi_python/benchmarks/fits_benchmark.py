@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Time loading FITS images of each BITPIX type with simple_fits. The
+image is a zero copy view of the FITS data, converting it to native
+byte order is done in place if the data is writable (a bytearray),
+otherwise it has to be copied.
+
+For comparison 'copy' is the time to make a (big endian) copy of the
+data, which is what slicing the data out of the FITS string costs.
+"""
+
+import argparse
+import numpy
+import time
+
+import indi_python.simple_fits as simpleFits
+
+
+def makeFITSImage(size, bitpix):
+    """
+    Returns a size x size FITS image with the given BITPIX.
+    """
+    header = ""
+    for card in ["SIMPLE  =                    T",
+                 "BITPIX  = {0:20d}".format(bitpix),
+                 "NAXIS   =                    2",
+                 "NAXIS1  = {0:20d}".format(size),
+                 "NAXIS2  = {0:20d}".format(size),
+                 "END"]:
+        header += "{0:80s}".format(card)
+    header += " " * (-len(header) % 2880)
+
+    image = numpy.random.uniform(low = 0, high = 100, size = (size, size))
+    return header.encode("ascii") + image.astype(simpleFits.BITPIX_TYPES[bitpix]).tobytes()
+
+def timeIt(fn, repeats):
+    """
+    Returns the average time of fn() in milliseconds.
+    """
+    start_time = time.perf_counter()
+    for i in range(repeats):
+        fn()
+    return (time.perf_counter() - start_time) * 1.0e3/repeats
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'FITS loading benchmark.')
+
+    parser.add_argument('--repeats', dest='repeats', type=int, required=False, default=10,
+                        help = "The number of times to load each image.")
+
+    args = parser.parse_args()
+
+    print("{0:>6s} {1:>6s} {2:>10s} {3:>10s} {4:>10s} {5:>14s} {6:>14s}".format("BITPIX", "size", "MB", "copy (ms)", "view (ms)",
+                                                                            "native (ms)", "in place (ms)"))
+    for bitpix in [8, 16, 32, 64, -32, -64]:
+        for size in [512, 2048, 4096]:
+            fits_data = makeFITSImage(size, bitpix)
+            fits_array = bytearray(fits_data)
+
+            copy_time = timeIt(lambda: numpy.frombuffer(fits_data[2880:], dtype = simpleFits.BITPIX_TYPES[bitpix]), args.repeats)
+            view_time = timeIt(lambda: simpleFits.FitsImage(fits_string = fits_data), args.repeats)
+            native_time = timeIt(lambda: simpleFits.FitsImage(fits_string = fits_data, native = True), args.repeats)
+
+            # This swaps the data back and forth, which doesn't matter here.
+            in_place_time = timeIt(lambda: simpleFits.FitsImage(fits_string = fits_array, native = True), args.repeats)
+
+            print("{0:6d} {1:6d} {2:10.2f} {3:10.3f} {4:10.3f} {5:14.3f} {6:14.3f}".format(bitpix,
+                                                                                        size,
+                                                                                        len(fits_data)/2**20,
+                                                                                        copy_time,
+                                                                                        view_time,
+                                                                                        native_time,
+                                                                                        in_place_time))
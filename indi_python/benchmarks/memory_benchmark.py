@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Measure the memory used to hold all the messages of a full property
+dump from an indiserver, using the compact indi_xml classes and a
+reconstruction of the original dictionary based layout.
+
+A dump can be recorded with something like:
+
+echo '<getProperties version="1.7"/>' | nc -q 5 localhost 7624 > dump.xml
+
+Without a dump a synthetic one is generated.
+"""
+
+import argparse
+import tracemalloc
+
+import indi_python.indi_stream as indiStream
+
+
+class LegacyINDIObject(object):
+    """
+    The original layout, a per-instance __dict__ with an attribute
+    dictionary, a string value and a list of elements.
+    """
+    def __init__(self, etree):
+        self.etype = etree.tag
+        self.attr = {}
+        for key in etree.attrib:
+            self.attr[key] = etree.attrib[key]
+
+        if (len(etree) > 0):
+            self.elt_list = []
+            for node in etree:
+                self.elt_list.append(LegacyINDIObject(node))
+        else:
+            self.value = ""
+            if etree.text is not None:
+                self.value = etree.text.strip()
+
+
+class LegacyDecoder(indiStream.INDIStreamDecoder):
+
+    def messageReady(self, etree):
+        self.messages.append(LegacyINDIObject(etree))
+
+
+def makeDump(n_devices, n_properties):
+    """
+    Returns a synthetic property dump.
+    """
+    dump = ""
+    for i in range(n_devices):
+        device = "Device " + str(i)
+        for j in range(n_properties):
+            name = "PROPERTY_" + str(j)
+            dump += '<defNumberVector device="' + device + '" name="' + name + '" label="Property ' + str(j) + '" '
+            dump += 'group="Main Control" state="Idle" perm="rw" timeout="60" timestamp="2017-02-01T12:00:00">\n'
+            for k in range(4):
+                dump += '  <defNumber name="' + name + '_' + str(k) + '" label="Value ' + str(k) + '" '
+                dump += 'format="%g" min="0" max="100" step="1">\n' + str(k * 1.5) + '\n  </defNumber>\n'
+            dump += '</defNumberVector>\n'
+
+            dump += '<defSwitchVector device="' + device + '" name="' + name + '_SWITCH" label="Switch" '
+            dump += 'group="Main Control" state="Idle" perm="rw" rule="OneOfMany" timeout="60">\n'
+            for k in ["ON", "OFF"]:
+                dump += '  <defSwitch name="' + k + '" label="' + k + '">\nOff\n  </defSwitch>\n'
+            dump += '</defSwitchVector>\n'
+    return dump.encode("utf-8")
+
+def measure(decoder, dump):
+    """
+    Returns [number of messages, bytes retained].
+    """
+    tracemalloc.start()
+    messages = decoder.feed(dump)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return [len(messages), size]
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'INDI message memory benchmark.')
+
+    parser.add_argument('--devices', dest='devices', type=int, required=False, default=20,
+                        help = "The number of devices in the synthetic dump.")
+    parser.add_argument('--dump', dest='dump', type=str, required=False,
+                        help = "A recorded INDI stream to use instead of a synthetic one.")
+    parser.add_argument('--properties', dest='properties', type=int, required=False, default=200,
+                        help = "The number of properties per device in the synthetic dump.")
+
+    args = parser.parse_args()
+
+    if args.dump is not None:
+        with open(args.dump, "rb") as fp:
+            dump = fp.read()
+    else:
+        dump = makeDump(args.devices, args.properties)
+
+    print("{0:>10s} {1:>10s} {2:>12s} {3:>16s}".format("layout", "messages", "memory (MB)", "bytes/message"))
+    for [name, decoder] in [["legacy", LegacyDecoder()], ["compact", indiStream.INDIStreamDecoder()]]:
+        [n_messages, size] = measure(decoder, dump)
+        print("{0:>10s} {1:10d} {2:12.2f} {3:16.0f}".format(name, n_messages, size/2**20, size/n_messages))
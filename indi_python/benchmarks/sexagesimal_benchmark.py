@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Measure the import time of indi_xml and the throughput of sexagesimal
+number parsing, natively and (if it is available) with astropy.
+"""
+
+import argparse
+import random
+import subprocess
+import sys
+import time
+
+import indi_python.indi_xml as indiXML
+import indi_python.sexagesimal as sexagesimal
+
+
+def importTime(module):
+    """
+    Time the import of a module in a fresh interpreter.
+    """
+    code = "import time; t = time.perf_counter(); import " + module + "; print(time.perf_counter() - t)"
+    try:
+        return float(subprocess.check_output([sys.executable, "-c", code], stderr = subprocess.DEVNULL))
+    except subprocess.CalledProcessError:
+        return None
+
+def perCall(fn, values):
+    """
+    Returns the time per value in microseconds.
+    """
+    start_time = time.perf_counter()
+    for value in values:
+        fn(value)
+    return (time.perf_counter() - start_time) * 1.0e6/len(values)
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'Sexagesimal parsing benchmark.')
+
+    parser.add_argument('--distinct', dest='distinct', type=int, required=False, default=100,
+                        help = "The number of distinct values.")
+    parser.add_argument('--repeats', dest='repeats', type=int, required=False, default=100000,
+                        help = "The number of values to parse.")
+
+    args = parser.parse_args()
+
+    # Import time.
+    for module in ["indi_python.indi_xml", "astropy.coordinates"]:
+        import_time = importTime(module)
+        if import_time is None:
+            print("{0:>24s} import not available".format(module))
+        else:
+            print("{0:>24s} import {1:.3f}s".format(module, import_time))
+    print("")
+
+    # Per call throughput.
+    distinct = []
+    for i in range(args.distinct):
+        value = random.uniform(-90.0, 90.0)
+        distinct.append(sexagesimal.formatSexagesimal(value, precision = 2))
+    values = [random.choice(distinct) for i in range(args.repeats)]
+
+    print("{0:>24s} {1:>10s}".format("method", "us/value"))
+    print("{0:>24s} {1:10.3f}".format("native (uncached)", perCall(sexagesimal.parseSexagesimal.__wrapped__, values)))
+    print("{0:>24s} {1:10.3f}".format("native (cached)", perCall(sexagesimal.parseSexagesimal, values)))
+    print("{0:>24s} {1:10.3f}".format("numberValue", perCall(indiXML.numberValue, values)))
+
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        start_time = time.perf_counter()
+        sexagesimal.parseSexagesimalArray(numpy.array(values))
+        print("{0:>24s} {1:10.3f}".format("array", (time.perf_counter() - start_time) * 1.0e6/len(values)))
+
+    try:
+        import astropy.coordinates
+        import astropy.units
+    except ImportError:
+        pass
+    else:
+        fn = lambda x: astropy.coordinates.Angle(x, unit = astropy.units.deg)
+        print("{0:>24s} {1:10.3f}".format("astropy", perCall(fn, values[:1000])))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Compare serializing INDI commands with toXML(), which builds an
+ElementTree, and writeXML(), which writes the XML directly into a
+reused buffer.
+"""
+
+import argparse
+import time
+
+import indi_python.indi_xml as indiXML
+
+
+def makeTelemetry(n_elements):
+    """
+    Returns a setNumberVector with n_elements numbers.
+    """
+    numbers = []
+    for i in range(n_elements):
+        numbers.append(indiXML.oneNumber(i * 0.5, indi_attr = {"name" : "VALUE_" + str(i)}))
+    return indiXML.setNumberVector(numbers, indi_attr = {"device" : "Telescope Simulator",
+                                                         "name" : "TELEMETRY",
+                                                         "state" : "Ok",
+                                                         "timestamp" : "2017-02-01T12:00:00"})
+
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description = 'INDI XML writer benchmark.')
+
+    parser.add_argument('--batch', dest='batch', type=int, required=False, default=100,
+                        help = "The number of commands per batch.")
+    parser.add_argument('--repeats', dest='repeats', type=int, required=False, default=200,
+                        help = "The number of batches.")
+
+    args = parser.parse_args()
+
+    print("{0:>10s} {1:>14s} {2:>14s}".format("elements", "toXML (us)", "writeXML (us)"))
+    for n_elements in [1, 2, 4, 8, 16]:
+        commands = [makeTelemetry(n_elements) for i in range(args.batch)]
+
+        # Check that they agree.
+        buffer = bytearray()
+        commands[0].writeXML(buffer)
+        assert (bytes(buffer) == commands[0].toXML())
+
+        start_time = time.perf_counter()
+        for i in range(args.repeats):
+            data = b''
+            for command in commands:
+                data += command.toXML() + b'\n'
+        et_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for i in range(args.repeats):
+            del buffer[:]
+            for command in commands:
+                command.writeXML(buffer)
+                buffer += b'\n'
+        direct_time = time.perf_counter() - start_time
+
+        n_commands = args.repeats * args.batch
+        print("{0:10d} {1:14.2f} {2:14.2f}".format(n_elements, et_time * 1.0e6/n_commands, direct_time * 1.0e6/n_commands))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+Manage connections to many INDI servers from a single asyncio event
+loop, one AsyncIndiClient per server.
+
+The messages from all of the servers are merged into a single stream
+of (server name, message) pairs. Messages that are sent to a device
+are routed to the server that the device is on, which we learn from
+the messages that the servers send.
+
+Usage:
+
+async with ConnectionManager() as manager:
+    await manager.addServer("pier1", "192.168.1.10")
+    await manager.addServer("pier2", "192.168.1.11")
+    manager.send(indiXML.clientGetProperties(indi_attr = {"version" : "1.7"}))
+    async for [server_name, message] in manager:
+        print(server_name, message)
+"""
+
+import asyncio
+
+import indi_python.async_indi_client as asyncIndiClient
+import indi_python.indi_xml as indiXML
+
+
+class ConnectionManagerException(Exception):
+    pass
+
+
+class ConnectionManager(object):
+
+    def __init__(self, max_queue = 0, **kwds):
+        """
+        max_queue - The maximum number of messages waiting in the merged
+            stream, 0 for no limit. When it is full we stop reading from
+            the servers. Messages are only queued while there is an
+            'async for' over the manager.
+        """
+        super().__init__(**kwds)
+        self.clients = {}
+        self.consumers = 0
+        self.device_servers = {}
+        self.forward_tasks = {}
+        self.max_queue = max_queue
+        self.queue = asyncio.Queue(maxsize = max_queue)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __aiter__(self):
+        return self.iterMessages()
+
+    async def addServer(self, server_name, ip_address, port = 7624, **kwds):
+        """
+        Connect to an INDI server, kwds are passed to AsyncIndiClient.
+        Returns the AsyncIndiClient.
+        """
+        if server_name in self.clients:
+            raise ConnectionManagerException("Server " + server_name + " already exists.")
+
+        client = asyncIndiClient.AsyncIndiClient(ip_address, port = port, max_queue = self.max_queue, **kwds)
+        await client.connect()
+        self.clients[server_name] = client
+        self.forward_tasks[server_name] = asyncio.ensure_future(self.forwardMessages(server_name, client))
+        return client
+
+    async def close(self):
+        for server_name in list(self.clients):
+            await self.removeServer(server_name)
+
+        # The end of iteration marker, the queue may be full.
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+    async def drain(self):
+        """
+        Wait until the outgoing data for all the servers has been handed
+        to the operating system.
+        """
+        await asyncio.gather(*[x.drain() for x in self.clients.values()])
+
+    async def forwardMessages(self, server_name, client):
+        """
+        Copy the messages from a client to the merged stream, noting
+        which server each device is on.
+        """
+        try:
+            async for message in client:
+                if message.hasAttr("device"):
+                    device = message.getAttr("device")
+                    if isinstance(message, indiXML.DelProperty) and not message.hasAttr("name"):
+                        self.device_servers.pop(device, None)
+                    else:
+                        self.device_servers[device] = server_name
+                if (self.consumers > 0):
+                    await self.queue.put([server_name, message])
+
+        except Exception as exception:
+            print("ConnectionManager: server", server_name, "failed,", str(exception))
+
+    def getClient(self, server_name):
+        return self.clients[server_name]
+
+    def getDevices(self, server_name = None):
+        """
+        The devices that we have heard from, on all servers or just
+        on server_name.
+        """
+        return sorted([x for x in self.device_servers if (server_name is None) or (self.device_servers[x] == server_name)])
+
+    def getServer(self, device):
+        """
+        Returns the name of the server that device is on.
+        """
+        try:
+            return self.device_servers[device]
+        except KeyError:
+            raise ConnectionManagerException("Unknown device " + device + ".")
+
+    def getServerNames(self):
+        return list(self.clients)
+
+    async def iterMessages(self):
+        """
+        Yields [server name, message], the iteration stops when the
+        manager is closed. Messages are queued while this is running.
+        """
+        self.consumers += 1
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    self.queue.put_nowait(None)
+                    return
+                yield item
+
+        finally:
+            # Nobody is iterating, so nobody will take these.
+            self.consumers -= 1
+            if (self.consumers == 0):
+                closed = False
+                while not self.queue.empty():
+                    if self.queue.get_nowait() is None:
+                        closed = True
+                if closed:
+                    self.queue.put_nowait(None)
+
+    async def removeServer(self, server_name):
+        client = self.clients.pop(server_name)
+        await client.close()
+
+        task = self.forward_tasks.pop(server_name)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        self.device_servers = {x : self.device_servers[x] for x in self.device_servers if (self.device_servers[x] != server_name)}
+
+    def send(self, indi_elt, server_name = None):
+        """
+        Send a message to server_name. If server_name is None the message
+        goes to the server that its device is on, or to all the servers
+        if it is not for a particular device (such as getProperties).
+        """
+        if server_name is None:
+            if indi_elt.hasAttr("device"):
+                server_name = self.getServer(indi_elt.getAttr("device"))
+            else:
+                for client in self.clients.values():
+                    client.send(indi_elt)
+                return
+        self.clients[server_name].send(indi_elt)
+
+    async def waitForProperty(self, device, name, state = None, timeout = None):
+        """
+        See AsyncIndiClient.waitForProperty(), device must be known.
+        """
+        client = self.clients[self.getServer(device)]
+        return await client.waitForProperty(device, name, state = state, timeout = timeout)
+
+
+if (__name__ == "__main__"):
+
+    import time
+
+    import indi_python.indi_stream as indiStream
+
+    #
+    # A test against many fake INDI servers on the loopback interface.
+    #
+    def makeFakeServer(device):
+
+        async def fakeServer(reader, writer):
+            """
+            Defines a property when asked, then echoes newNumberVector
+            as an Ok setNumberVector.
+            """
+            decoder = indiStream.INDIStreamDecoder()
+            while True:
+                data = await reader.read(2**16)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    if isinstance(message, indiXML.GetProperties):
+                        reply = indiXML.defNumberVector([indiXML.defNumber(0.0, indi_attr = {"name" : "RA",
+                                                                                               "iformat" : "%g",
+                                                                                               "imin" : 0,
+                                                                                               "imax" : 24,
+                                                                                               "step" : 0})],
+                                                        indi_attr = {"device" : device,
+                                                                     "name" : "COORD",
+                                                                     "perm" : "rw",
+                                                                     "state" : "Idle"})
+                    elif isinstance(message, indiXML.NewNumberVector):
+                        reply = indiXML.setNumberVector([indiXML.oneNumber(message.getElt(0).getValue(), indi_attr = {"name" : "RA"})],
+                                                        indi_attr = {"device" : device,
+                                                                     "name" : "COORD",
+                                                                     "state" : "Ok"})
+                    else:
+                        continue
+                    writer.write(reply.toXML() + b'\n')
+            writer.close()
+
+        return fakeServer
+
+    async def main(n_servers):
+        servers = []
+        async with ConnectionManager() as manager:
+            start_time = time.perf_counter()
+            for i in range(n_servers):
+                server = await asyncio.start_server(makeFakeServer("Mount " + str(i)), "127.0.0.1", 0)
+                servers.append(server)
+                await manager.addServer("pier" + str(i), "127.0.0.1", port = server.sockets[0].getsockname()[1])
+
+            # Ask every server for its properties.
+            manager.send(indiXML.clientGetProperties(indi_attr = {"version" : "1.7"}))
+            count = 0
+            async for [server_name, message] in manager:
+                count += 1
+                if (count == n_servers):
+                    break
+            print("connected to", n_servers, "servers in {0:.3f}s".format(time.perf_counter() - start_time))
+
+            # Route a command to each device, the waits have to start
+            # before the replies can arrive.
+            start_time = time.perf_counter()
+            waits = []
+            for i in range(n_servers):
+                waits.append(asyncio.ensure_future(manager.waitForProperty("Mount " + str(i), "COORD", state = "Ok", timeout = 5.0)))
+            await asyncio.sleep(0)
+
+            for i in range(n_servers):
+                manager.send(indiXML.newNumberVector([indiXML.oneNumber(i * 0.1, indi_attr = {"name" : "RA"})],
+                                                     indi_attr = {"device" : "Mount " + str(i), "name" : "COORD"}))
+            for i, message in enumerate(await asyncio.gather(*waits)):
+                assert (message.getElt(0).getValue() == i * 0.1)
+            print("round trip to", n_servers, "servers in {0:.3f}s".format(time.perf_counter() - start_time))
+            print(manager.getServer("Mount 7"), manager.getDevices("pier7"))
+
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main(60))
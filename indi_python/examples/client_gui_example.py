@@ -5,8 +5,6 @@ Simple example of the use of the indi-python library as a client.
 Hazen 11/16
 """
 
-import astropy.coordinates
-import astropy.units
 import numpy
 import os
 import sys
@@ -15,6 +13,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 
 import indi_python.indi_xml as indiXML
 import indi_python.qt_indi_client as qtIndiClient
+import indi_python.sexagesimal as sexagesimal
 import indi_python.simple_fits as simpleFits
 
 import client_gui_example_ui as clientGuiExampleUi
@@ -33,7 +32,7 @@ class CameraDisplayWidget(QtWidgets.QWidget):
         self.qt_image = None
 
     def newImage(self, numpy_image, im_min, im_max):
-        self.numpy_image = numpy_image.astype(numpy.float32)
+        self.numpy_image = numpy_image.astype(numpy.float32, copy = False)
         self.rescaleImage(im_min, im_max)
 
     def paintEvent(self, event):
@@ -141,8 +140,8 @@ class Window(QtWidgets.QMainWindow):
         self.ui.rangeSlider.setValues([int(self.settings.value("range_min", 0)), range_max])
 
         # Connect a (local) indiserver.
-        self.indi_client = qtIndiClient.QtINDIClient(parent = self)
-        self.indi_client.received.connect(self.handleReceived)
+        self.indi_client = qtIndiClient.QtINDIClient(parent = self, threaded = True)
+        self.indi_client.receivedBatch.connect(self.handleReceivedBatch)
 
         # Open connection to the CCD simulator (indi_simulator_ccd) and enable BLOB mode.
         self.indi_client.sendMessage(indiXML.newSwitchVector([indiXML.oneSwitch("On", indi_attr = {"name" : "CONNECT"})],
@@ -176,12 +175,12 @@ class Window(QtWidgets.QMainWindow):
 
     def handleDecTextEdited(self, new_text):
         try:
-            angle = astropy.coordinates.Angle(new_text, unit = astropy.units.deg)
-        except ValueError:
+            angle = sexagesimal.parseSexagesimal(new_text)
+        except sexagesimal.SexagesimalException:
             self.ui.decLineEdit.setStyleSheet("QLineEdit { background : red; }")
         else:
             self.ui.decLineEdit.setStyleSheet("QLineEdit { background : yellow; }")
-            self.cur_dec = angle.to_string(sep=":")
+            self.cur_dec = sexagesimal.formatSexagesimal(angle)
 
     def handleGoTo(self, boolean):
         # Update where the telescope is pointed.
@@ -197,12 +196,12 @@ class Window(QtWidgets.QMainWindow):
         
     def handleRaTextEdited(self, new_text):
         try:
-            angle = astropy.coordinates.Angle(new_text, unit = astropy.units.deg)
-        except ValueError:
+            angle = sexagesimal.parseSexagesimal(new_text)
+        except sexagesimal.SexagesimalException:
             self.ui.raLineEdit.setStyleSheet("QLineEdit { background : red; }")
         else:
             self.ui.raLineEdit.setStyleSheet("QLineEdit { background : yellow; }")
-            self.cur_ra = angle.to_string(sep=":")
+            self.cur_ra = sexagesimal.formatSexagesimal(angle)
 
     def handleReceived(self, message):
         print(message)
@@ -210,7 +209,13 @@ class Window(QtWidgets.QMainWindow):
         # Check for image BLOB from CCD1.
         if isinstance(message, indiXML.SetBLOBVector) and (message.getAttr("name") == "CCD1"):
             if isinstance(message.getElt(0), indiXML.OneBLOB):
-                np_image = simpleFits.FitsImage(fits_string = message.getElt(0).getValue()).getImage()
+                np_image = simpleFits.FitsImage(fits_string = message.getElt(0).getValue()).getImage(dtype = numpy.float32)
+
+                # We can only display gray-scale images.
+                if (np_image.ndim != 2):
+                    print("RGB image detected. Image type not set to 'RAW'?")
+                    return
+
                 im_min = int(self.ui.rangeMinLabel.text())
                 im_max = int(self.ui.rangeMaxLabel.text())
                 self.camera_display_widget.newImage(np_image, im_min, im_max)
@@ -218,7 +223,7 @@ class Window(QtWidgets.QMainWindow):
 
         # Check for updated exposure time form CCD1.
         if isinstance(message, indiXML.SetNumberVector) and (message.getAttr("name") == "CCD_EXPOSURE"):
-            remaining_time = float(message.getElt(0).getValue())
+            remaining_time = message.getElt(0).getValue()
             if (remaining_time == 0.0):
                 self.ui.capturePushButton.setText("Capture")
                 self.ui.capturePushButton.setEnabled(True)
@@ -229,14 +234,23 @@ class Window(QtWidgets.QMainWindow):
         # Check for updated position.
         if isinstance(message, indiXML.SetNumberVector) and (message.getAttr("name") == "EQUATORIAL_EOD_COORD"):
             self.moving_timer.start()
-            mount_ra = astropy.coordinates.Angle(float(message.getElt(0).getValue()), unit = astropy.units.deg)
-            self.cur_ra = mount_ra.to_string(sep=":")
+            self.cur_ra = sexagesimal.formatSexagesimal(message.getElt(0).getValue())
             self.ui.raLineEdit.setText(self.cur_ra)
             
-            mount_dec = astropy.coordinates.Angle(float(message.getElt(1).getValue()), unit = astropy.units.deg)
-            self.cur_dec = mount_dec.to_string(sep=":")
+            self.cur_dec = sexagesimal.formatSexagesimal(message.getElt(1).getValue())
             self.ui.decLineEdit.setText(self.cur_dec)
 
+    def handleReceivedBatch(self, messages, coalesced):
+
+        # If the batch was coalesced we are falling behind, so only
+        # display the most recent image.
+        if coalesced:
+            blobs = [x for x in messages if isinstance(x, indiXML.SetBLOBVector)]
+            messages = [x for x in messages if not isinstance(x, indiXML.SetBLOBVector)] + blobs[-1:]
+
+        for message in messages:
+            self.handleReceived(message)
+
     def handleStabilized(self):
         self.ui.decLineEdit.setStyleSheet("QLineEdit { background : white; }")
         self.ui.raLineEdit.setStyleSheet("QLineEdit { background : white; }")
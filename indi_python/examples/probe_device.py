@@ -6,7 +6,6 @@ Hazen 02/17
 """
 
 import argparse
-import time
 
 import indi_python.basic_indi_client as basicIndiClient
 import indi_python.indi_xml as indiXML
@@ -32,16 +31,24 @@ bic = basicIndiClient.BasicIndiClient(args.ipaddress, args.port, timeout)
 # Query device
 print("querying..")
 bic.sendMessage(indiXML.clientGetProperties(indi_attr = {"version" : "1.0", "device" : args.device}))
-time.sleep(timeout)
+bic.waitForProperty(args.device, "CONNECTION", state = None, timeout = timeout, keep = True)
 
 # Connect to user requested device.
 print("connecting..")
 bic.sendMessage(indiXML.newSwitchVector([indiXML.oneSwitch("On", indi_attr = {"name" : "CONNECT"})],
                                         indi_attr = {"name" : "CONNECTION", "device" : args.device}))
-time.sleep(timeout)
-
-# Get all the XML that was sent in response to the above.
-messages = bic.waitMessages()
+bic.waitForProperty(args.device, "CONNECTION", timeout = 10.0, keep = True)
+
+# Get all the XML that was sent in response to the above, this
+# stops once the device has been quiet for timeout seconds.
+messages = []
+while True:
+    new_messages = bic.getMessages()
+    if new_messages is None:
+        continue
+    if not new_messages:
+        break
+    messages.extend(new_messages)
 
 # Print the messages.
 for message in messages:
@@ -6,10 +6,7 @@ Hazen 02/17
 """
 
 import argparse
-import fitsio
-import numpy
 import os
-import time
 
 import indi_python.basic_indi_client as basicIndiClient
 import indi_python.indi_xml as indiXML
@@ -22,6 +19,8 @@ parser = argparse.ArgumentParser(description = 'Captures a single image from a c
 
 parser.add_argument('--camera', dest='camera', type=str, required=True,
                     help = "The name of the camera device.")
+parser.add_argument('--compress', dest='compress', action='store_true',
+                    help = "Ask the camera to send zlib compressed images.")
 parser.add_argument('--exptime', dest='exptime', type=float, required=False, default="0.1",
                     help = "The exposure time in seconds.")
 parser.add_argument('--fits', dest='fits', type=str, required=False, default="capture.fits",
@@ -42,7 +41,10 @@ bic = basicIndiClient.BasicIndiClient(args.ipaddress, args.port, timeout = timeo
 bic.sendMessage(indiXML.newSwitchVector([indiXML.oneSwitch("On", indi_attr = {"name" : "CONNECT"})],
                                         indi_attr = {"name" : "CONNECTION", "device" : args.camera}))
 bic.sendMessage(indiXML.enableBLOB("Also", indi_attr = {"device" : args.camera}))
-time.sleep(timeout)
+if args.compress:
+    bic.sendMessage(indiXML.ccdCompression(args.camera))
+if bic.waitForProperty(args.camera, "CONNECTION", timeout = 10.0) is None:
+    print("Timed out connecting to", args.camera)
 
 # With 'GPhoto CCD' we need to probe to get the image size.
 if (args.camera == "GPhoto CCD"):
@@ -54,27 +56,20 @@ if (args.camera == "GPhoto CCD"):
                                              indiXML.oneNumber(1, indi_attr = {"name" : "CCD_PIXEL_SIZE_Y"}),
                                              indiXML.oneNumber(16, indi_attr = {"name" : "CCD_BITSPERPIXEL"})],
                                             indi_attr = {"name" : "CCD_INFO", "device" : args.camera}))
-    time.sleep(timeout)
+    bic.waitForProperty(args.camera, "CCD_INFO", timeout = 10.0)
 
 # Request a picture.
 print("Starting capture")
 bic.sendMessage(indiXML.newNumberVector([indiXML.oneNumber(args.exptime, indi_attr = {"name" : "CCD_EXPOSURE_VALUE"})],
                                         indi_attr = {"name" : "CCD_EXPOSURE", "device" : args.camera}))
-time.sleep(timeout)
 
 # Wait for image.
 print("Waiting for image")
-np_image = None
-while True:
-    messages = bic.waitMessages()
-    for message in messages:
-        if isinstance(message, indiXML.SetBLOBVector):
-            np_image = simpleFits.FitsImage(fits_string = message.getElt(0).getValue()).getImage().astype(numpy.uint16)
-    if np_image is not None:
-        break
+message = bic.waitFor(lambda x: isinstance(x, indiXML.SetBLOBVector))
+fits_image = simpleFits.FitsImage(fits_string = message.getElt(0).getValue())
 
-# Save the image.
-fitsio.write(args.fits, np_image, clobber = True)
+# Save the image, this writes the FITS data from the camera unchanged.
+fits_image.write(args.fits)
 
 # Close the connection.
 bic.close()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""
+Incremental decoder for the INDI XML stream.
+
+An INDI connection is an endless sequence of top-level XML elements
+without a document root. Rather than re-parsing the whole receive
+buffer every time more data arrives, this feeds each chunk exactly
+once to an expat based feed parser and hands back every top-level
+INDI message as soon as its closing tag has been seen.
+
+Optionally BLOB payloads can be decoded from base64 as they come off
+the socket, straight into a preallocated buffer or into a file, so
+that the encoded text is never held in memory. zlib compressed BLOBs
+(.z, .fits.z) are decompressed in the same pass.
+"""
+
+import binascii
+import os
+import tempfile
+import traceback
+import zlib
+from xml.etree import ElementTree
+
+import indi_python.indi_xml as indiXML
+
+
+class IndiStreamException(Exception):
+    pass
+
+
+class IndiStreamOverflow(IndiStreamException):
+    pass
+
+
+class BLOBSink(object):
+    """
+    Decodes a base64 BLOB payload incrementally. The payload goes into a
+    bytearray preallocated using the BLOB size, or into a (temporary)
+    file if the size is larger than spill_size.
+
+    If compressed is True the payload is zlib compressed and is
+    decompressed as it is decoded. As per the INDI specification size
+    is the size after decompression.
+    """
+    def __init__(self, size = 0, suffix = None, spill_size = None, directory = None, compressed = False, **kwds):
+        super().__init__(**kwds)
+        self.buffer = None
+        self.decompressor = None
+        self.filename = None
+        self.fp = None
+        self.n_bytes = 0
+        self.pending = b""
+
+        if compressed:
+            self.decompressor = zlib.decompressobj()
+
+        if spill_size is not None and (size > spill_size):
+            [fd, self.filename] = tempfile.mkstemp(prefix = "indi_", suffix = suffix, dir = directory)
+            self.fp = os.fdopen(fd, "wb")
+        else:
+            self.buffer = bytearray(size)
+
+    def abort(self):
+        """
+        Throw away the partial BLOB.
+        """
+        if self.fp is not None:
+            self.fp.close()
+            os.remove(self.filename)
+        self.buffer = None
+        self.fp = None
+
+    def close(self):
+        """
+        Returns [value, filename], one of which will be None.
+        """
+        if self.pending:
+            self.writeBinary(binascii.a2b_base64(self.pending))
+            self.pending = b""
+
+        if self.decompressor is not None:
+            self.writeDecoded(self.decompressor.flush())
+            self.decompressor = None
+
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+            return [None, self.filename]
+
+        # Size is only a hint, so this could have been too large.
+        if (self.n_bytes < len(self.buffer)):
+            del self.buffer[self.n_bytes:]
+        return [self.buffer, None]
+
+    def write(self, text):
+        """
+        Add the next chunk of base64 encoded text. Only whole groups of
+        4 characters are decoded, the remainder waits for the next chunk.
+        """
+        data = self.pending + text.encode("ascii").translate(None, b" \t\r\n")
+        n_chars = 4 * (len(data) // 4)
+        if (n_chars < len(data)):
+            self.pending = data[n_chars:]
+            data = data[:n_chars]
+        else:
+            self.pending = b""
+        if data:
+            self.writeBinary(binascii.a2b_base64(data))
+
+    def writeBinary(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.writeDecoded(data)
+
+    def writeDecoded(self, data):
+        if self.fp is not None:
+            self.fp.write(data)
+        else:
+            self.buffer[self.n_bytes:self.n_bytes + len(data)] = data
+        self.n_bytes += len(data)
+
+
+class INDIStreamDecoder(object):
+    """
+    Usage:
+
+    decoder = INDIStreamDecoder()
+    for message in decoder.feed(a_socket.recv(2**20)):
+        print(message)
+
+    Messages can be filtered by type (etypes), by device (setDevice()) and
+    by subscription (subscribe()). These are all checked against the attributes of the raw
+    XML so that no INDI object is built (and no BLOB is decoded) for a
+    message that nobody wants. Subscriber callbacks are called with the
+    INDI object from feed(), i.e. in the thread that reads the socket.
+    """
+    def __init__(self,
+                 blob_directory = None,
+                 blob_spill_size = None,
+                 encoding = None,
+                 etypes = None,
+                 lazy_blobs = False,
+                 max_message_size = None,
+                 overflow = "raise",
+                 stream_blobs = False,
+                 **kwds):
+        """
+        blob_directory - Where to put BLOBs that are spilled to disk, the
+                         default is the system temporary directory.
+
+        blob_spill_size - When streaming, BLOBs larger than this (in bytes)
+                          are decoded into a file instead of memory. Use
+                          OneBLOB.getFilename() to find the file, which
+                          then belongs to the application.
+
+        encoding - Override the stream encoding, the default is UTF-8 as
+                   per the XML specification.
+
+        etypes - Only decode messages of these types (XML tags, such as
+                 "setBLOBVector"), None for all types.
+
+        lazy_blobs - Only decode BLOBs when their value is requested.
+
+        max_message_size - The maximum amount of text (in characters) that
+                           we will buffer for a single message, None for
+                           no limit.
+
+        overflow - What to do with a message that is larger than
+                   max_message_size. In both cases the rest of the
+                   message is skipped without being buffered.
+                     "discard" - Quietly drop the message.
+                     "raise" - Raise IndiStreamOverflow from feed().
+
+        stream_blobs - Decode BLOBs as they arrive, this is not subject to
+                       max_message_size as the encoded text is not kept.
+        """
+        super().__init__(**kwds)
+        self.blob_directory = blob_directory
+        self.blob_spill_size = blob_spill_size
+        self.encoding = encoding
+        self.etypes = None if (etypes is None) else frozenset(etypes)
+        self.lazy_blobs = lazy_blobs
+        self.max_message_size = max_message_size
+        self.overflow = overflow
+        self.stream_blobs = stream_blobs
+
+        if not overflow in ["discard", "raise"]:
+            raise IndiStreamException("Unknown overflow policy '" + str(overflow) + "'.")
+
+        self.blob_sinks = []
+        self.device = None
+        self.subscriptions = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Discard any partial message and start over with a fresh parser.
+        """
+        self.abortBLOBs()
+        self.builder = None
+        self.callbacks = []
+        self.depth = 0
+        self.discarding = False
+        self.message_size = 0
+        self.messages = []
+        self.overflowed = None
+        self.top_tag = None
+
+        self.parser = ElementTree.XMLParser(target = self, encoding = self.encoding)
+
+        # The INDI stream has no root element so we supply one.
+        self.parser.feed(b"<data>")
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the stream, which can be bytes, a bytearray
+        or a memoryview. Returns a (possibly empty) list of the INDI objects
+        whose elements were completed by this chunk.
+        """
+        try:
+            self.parser.feed(data)
+        except ElementTree.ParseError as exception:
+            self.reset()
+            raise IndiStreamException("INDI stream is not valid XML, " + str(exception))
+
+        # Any messages that were completed in this chunk are kept
+        # for the next call to feed().
+        if self.overflowed is not None:
+            tag = self.overflowed
+            self.overflowed = None
+            raise IndiStreamOverflow(tag + " is larger than " + str(self.max_message_size) + " characters.")
+
+        messages = self.messages
+        self.messages = []
+        return messages
+
+    def abortBLOBs(self):
+        for blob_sink in self.blob_sinks:
+            blob_sink.abort()
+        self.blob_sink = None
+        self.blob_sinks = []
+
+    def findCallbacks(self, tag, attrib):
+        """
+        Returns the callbacks that have subscribed to this message (which
+        will be empty if there are no subscriptions), or None if the
+        message should be dropped.
+        """
+        if self.etypes is not None and not (tag in self.etypes):
+            return None
+
+        device = attrib.get("device")
+        if self.device is not None and (device != self.device):
+            return None
+
+        if not self.subscriptions:
+            return []
+
+        # If the message has no device (or name) each key would otherwise
+        # be looked up, and its callbacks called, more than once.
+        callbacks = []
+        name = attrib.get("name")
+        for a_device in dict.fromkeys([device, None]):
+            for a_name in dict.fromkeys([name, None]):
+                for a_tag in dict.fromkeys([tag, None]):
+                    callbacks.extend(self.subscriptions.get((a_device, a_name, a_tag), []))
+
+        if callbacks:
+            return callbacks
+        return None
+
+    def hasPartialMessage(self):
+        """
+        True if we are part way through a top-level message.
+        """
+        return (self.depth > 1)
+
+    def messageReady(self, etree):
+        """
+        Called with the ElementTree of each complete top-level message.
+        """
+        # Streamed BLOBs have no text to decode.
+        indi_message = indiXML.parseETree(etree, lazy_blobs = (self.lazy_blobs or self.stream_blobs))
+
+        # Give the streamed BLOBs to their elements.
+        if self.blob_sinks:
+            blobs = [x for x in indi_message.getEltList() if isinstance(x, indiXML.OneBLOB)]
+            for [blob, blob_sink] in zip(blobs, self.blob_sinks):
+                [value, filename] = blob_sink.close()
+                if filename is not None:
+                    blob.setFilename(filename)
+                else:
+                    blob.setValue(value)
+            self.blob_sink = None
+            self.blob_sinks = []
+
+        self.messages.append(indi_message)
+
+        # A failing subscriber mustn't stop the others, or the decoding.
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback(indi_message)
+            except Exception:
+                print("INDIStreamDecoder: subscriber", callback, "failed on", indi_message.etype)
+                traceback.print_exc()
+
+    def setDevice(self, device = None):
+        """
+        Only decode messages from this device, None for all devices.
+        """
+        self.device = device
+
+    def subscribe(self, callback, device = None, name = None, etype = None):
+        """
+        Call callback with each message that matches device, property name
+        and message type (the XML tag, such as "setNumberVector"). None
+        matches anything.
+
+        Once there are subscriptions, messages that don't match any of
+        them are dropped without being decoded.
+        """
+        key = (device, name, etype)
+        if not key in self.subscriptions:
+            self.subscriptions[key] = []
+        self.subscriptions[key].append(callback)
+
+    def unsubscribe(self, callback, device = None, name = None, etype = None):
+        key = (device, name, etype)
+        self.subscriptions[key].remove(callback)
+        if not self.subscriptions[key]:
+            del self.subscriptions[key]
+
+    #
+    # ElementTree.XMLParser target interface.
+    #
+    def close(self):
+        pass
+
+    def data(self, data):
+        # Text between top-level messages is just whitespace.
+        if self.blob_sink is not None:
+            self.blob_sink.write(data)
+
+        elif (self.depth > 1) and not self.discarding:
+            self.message_size += len(data)
+            if self.max_message_size is not None and (self.message_size > self.max_message_size):
+                self.discardMessage()
+            else:
+                self.builder.data(data)
+
+    def discardMessage(self):
+        """
+        Drop what we have of the current (oversized) message and ignore
+        the rest of it.
+        """
+        if (self.overflow == "raise"):
+            self.overflowed = self.top_tag
+        self.abortBLOBs()
+        self.builder = None
+        self.callbacks = []
+        self.discarding = True
+
+    def end(self, tag):
+        self.depth -= 1
+        if self.discarding:
+            if (self.depth == 1):
+                self.discarding = False
+
+        elif (self.depth > 0):
+            self.blob_sink = None
+            etree = self.builder.end(tag)
+
+            # A top-level message is complete.
+            if (self.depth == 1):
+                self.builder = None
+                self.messageReady(etree)
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if (self.depth > 1) and not self.discarding:
+
+            # Start a new tree for each top-level message, this way we
+            # never keep a reference to messages that we've returned.
+            if (self.depth == 2):
+
+                # Skip messages that nobody wants.
+                self.callbacks = self.findCallbacks(tag, attrib)
+                if self.callbacks is None:
+                    self.callbacks = []
+                    self.discarding = True
+                    return
+
+                self.builder = ElementTree.TreeBuilder()
+                self.message_size = 0
+                self.top_tag = tag
+
+            # Decode the BLOB as it arrives.
+            elif self.stream_blobs and (self.depth == 3) and (tag == "oneBLOB"):
+                try:
+                    size = int(attrib.get("size", 0))
+                except ValueError:
+                    size = 0
+                blob_format = attrib.get("format", "")
+                self.blob_sink = BLOBSink(size = size,
+                                          suffix = indiXML.uncompressedFormat(blob_format),
+                                          compressed = indiXML.isCompressedFormat(blob_format),
+                                          spill_size = self.blob_spill_size,
+                                          directory = self.blob_directory)
+                self.blob_sinks.append(self.blob_sink)
+
+            self.builder.start(tag, attrib)
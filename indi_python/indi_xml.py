@@ -26,75 +26,199 @@ Notes:
 
 """
 
-import astropy.coordinates
-import astropy.units
 import base64
 import numbers
+import os
+import sys
+import types
+import zlib
 from xml.etree import ElementTree
 
+import indi_python.sexagesimal as sexagesimal
+
+
+# The attributes whose values are interned, these repeat a lot.
+INTERNED_ATTRIBUTES = frozenset(["device", "name"])
+
 
 class IndiXMLException(Exception):
     pass
 
 
+def escapeAttribute(text):
+    """
+    Escape an attribute value the same way as ElementTree.
+    """
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+def escapeText(text):
+    """
+    Escape element text the same way as ElementTree.
+    """
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
 class INDIBase(object):
     """
     INDI command base classes.
+
+    A full property dump from a busy indiserver creates tens of thousands
+    of these objects so they are kept compact. The attributes defined in
+    indi_spec are stored in a list using a fixed, per class, layout
+    (attr_index). Any other attributes go in a dictionary. Attribute
+    names and the device and (property / element) name values are
+    interned so that repeats share the same string. Other values, such
+    as timestamps and message text, are mostly unique so they aren't.
     """
+    __slots__ = ("attr_extra", "attr_values", "etype")
+
+    # These are filled in from indi_spec by makeAttrLayouts().
+    attr_index = {}
+    attr_names = []
+
     def __init__(self, etype, value, attr_dict, etree):
         self.etype = etype
-        self.attr = {}
+        self.attr_extra = None
+        self.attr_values = [None] * len(self.attr_names)
 
         if attr_dict is not None:
             for key in attr_dict:
                 self.addAttr(key, attr_dict[key])
         elif etree is not None:
-            self.etype = etree.tag
+            self.etype = sys.intern(etree.tag)
             for key in etree.attrib:
                 self.addAttr(key, etree.attrib[key])
         else:
             raise IndiXMLException("Dictionary of arguments or XML ElementTree required.")
 
     def __str__(self):
-        if "name" in self.attr:
-            base_str = self.etype + " (" + self.attr["name"]
-            if "device" in self.attr:
-                base_str += ", " + self.attr["device"]
-            if "perm" in self.attr:
-                base_str += ", " + self.attr["perm"]
+        if self.hasAttr("name"):
+            base_str = self.etype + " (" + self.getAttr("name")
+            if self.hasAttr("device"):
+                base_str += ", " + self.getAttr("device")
+            if self.hasAttr("perm"):
+                base_str += ", " + self.getAttr("perm")
             return base_str + ")"
         else:
             return self.etype + "()"
 
+    @property
+    def attr(self):
+        """
+        The attributes as a read only dictionary, use setAttr() to make changes.
+        """
+        return types.MappingProxyType(dict(self.iterAttr()))
+
     def addAttr(self, name, value):
-        self.attr[name] = value
+        if (name in INTERNED_ATTRIBUTES) and isinstance(value, str) and (len(value) < 64):
+            value = sys.intern(value)
+
+        index = self.attr_index.get(name)
+        if index is not None:
+            self.attr_values[index] = value
+        else:
+            if self.attr_extra is None:
+                self.attr_extra = {}
+            self.attr_extra[sys.intern(name)] = value
+
+    def decodeBLOBs(self):
+        pass
 
     def delAttr(self, name):
-        self.attr.pop(name)
+        index = self.attr_index.get(name)
+        if index is not None and self.attr_values[index] is not None:
+            self.attr_values[index] = None
+        elif self.attr_extra is not None:
+            self.attr_extra.pop(name)
+        else:
+            raise KeyError(name)
         
     def getAttr(self, name):
-        return self.attr[name]
+        index = self.attr_index.get(name)
+        if index is not None and self.attr_values[index] is not None:
+            return self.attr_values[index]
+        elif self.attr_extra is not None:
+            return self.attr_extra[name]
+        else:
+            raise KeyError(name)
+
+    def hasAttr(self, name):
+        index = self.attr_index.get(name)
+        if index is not None and self.attr_values[index] is not None:
+            return True
+        return (self.attr_extra is not None) and (name in self.attr_extra)
+
+    def iterAttr(self):
+        """
+        Iterate over the [name, value] pairs of the attributes.
+        """
+        for [name, value] in zip(self.attr_names, self.attr_values):
+            if value is not None:
+                yield [name, value]
+        if self.attr_extra is not None:
+            for name in self.attr_extra:
+                yield [name, self.attr_extra[name]]
 
     def setAttr(self, name, value):
-        self.attr[name] = value
+        self.addAttr(name, value)
 
     def toETree(self):
         etree = ElementTree.Element(self.etype)
 
         # Add attributes.
-        for key in self.attr:
-            etree.set(key, str(self.attr[key]))
+        for [key, value] in self.iterAttr():
+            etree.set(key, str(value))
 
         return etree
 
     def toXML(self):
         return ElementTree.tostring(self.toETree(), 'utf-8')
 
+    def writeXML(self, buffer):
+        """
+        Append the XML for this object to buffer, a bytearray. This gives
+        exactly the same XML as toXML() but doesn't build an ElementTree.
+        """
+        parts = []
+        self.xmlParts(parts)
+        buffer += "".join(parts).encode("utf-8", "xmlcharrefreplace")
+
+    def xmlParts(self, parts):
+        self.xmlStartTag(parts)
+        parts.append(" />")
+
+    def xmlStartTag(self, parts):
+        parts.append("<" + self.etype)
+        for [key, value] in self.iterAttr():
+            parts.append(" " + key + "=\"" + escapeAttribute(str(value)) + "\"")
+
     
 class INDIElement(INDIBase):
     """
     INDI element command base class.
     """
+    __slots__ = ("value",)
+
     def __init__(self, etype, value, attr_dict, etree):
         INDIBase.__init__(self, etype, None, attr_dict, etree)
         self.value = value
@@ -108,9 +232,15 @@ class INDIElement(INDIBase):
 
     def __str__(self):
         base_str = INDIBase.__str__(self)
-        if "label" in self.attr:
-            base_str += " '" + self.attr["label"] + "'"
-        return base_str + " " + self.value
+        if self.hasAttr("label"):
+            base_str += " '" + self.getAttr("label") + "'"
+        return base_str + " " + self.getText()
+
+    def getText(self):
+        """
+        The value as text.
+        """
+        return str(self.value)
 
     def getValue(self):
         return self.value
@@ -120,22 +250,64 @@ class INDIElement(INDIBase):
         
     def toETree(self):
         etree = INDIBase.toETree(self)
-        etree.text = str(self.value)
+        etree.text = self.getText()
         return etree
 
+    def xmlParts(self, parts):
+        text = self.getText()
+        if text:
+            self.xmlStartTag(parts)
+            parts.append(">" + escapeText(text) + "</" + self.etype + ">")
+        else:
+            INDIBase.xmlParts(self, parts)
+
     
+class INDINumber(INDIElement):
+    """
+    INDI number element base class.
+
+    The value is always a number, text (including sexagesimal text) is
+    converted to a float when the element is created. The original text
+    is kept and is used when converting back to XML.
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, etype, value, attr_dict, etree):
+        INDIElement.__init__(self, etype, value, attr_dict, etree)
+        self.text = None
+
+        if isinstance(self.value, str):
+            self.text = self.value
+            try:
+                self.value = sexagesimal.parseSexagesimal(self.text)
+            except sexagesimal.SexagesimalException:
+                self.value = float("nan")
+
+    def getText(self):
+        if self.text is not None:
+            return self.text
+        return str(self.value)
+
+    def setValue(self, value):
+        self.text = None
+        self.value = value
+
+
 class INDIVector(INDIBase):
     """
     INDI vector command base class.
+
+    The elements of a vector that was created from XML are stored
+    in a tuple.
     """
+    __slots__ = ("elt_list",)
+
     def __init__(self, etype, elt_list, attr_dict, etree):
         INDIBase.__init__(self, etype, None, attr_dict, etree)
         self.elt_list = elt_list
 
         if etree is not None:
-            self.elt_list = []
-            for node in etree:
-                self.elt_list.append(parseETree(node))
+            self.elt_list = tuple([parseETree(node, lazy_blobs = True) for node in etree])
 
     def __str__(self):
         elt_str = ""
@@ -143,120 +315,232 @@ class INDIVector(INDIBase):
             elt_str += "  " + str(elt) + "\n"
         return INDIBase.__str__(self) + "\n" + elt_str
 
+    def decodeBLOBs(self):
+        for elt in self.elt_list:
+            elt.decodeBLOBs()
+
     def getElt(self, index):
         return self.elt_list[index]
     
     def getEltList(self):
         return self.elt_list
 
+    def getValuesArray(self):
+        """
+        The element values of a number vector as a NumPy array.
+        """
+        import numpy
+        return numpy.fromiter([elt.value for elt in self.elt_list],
+                              dtype = numpy.float64,
+                              count = len(self.elt_list))
+
+    def getValuesDict(self):
+        """
+        The element values as a dictionary keyed by element name.
+        """
+        return {elt.getAttr("name") : elt.value for elt in self.elt_list}
+
     def toETree(self):
         etree = INDIBase.toETree(self)
         for elt in self.elt_list:
             etree.append(elt.toETree())
         return etree
+
+    def xmlParts(self, parts):
+        if self.elt_list:
+            self.xmlStartTag(parts)
+            parts.append(">")
+            for elt in self.elt_list:
+                elt.xmlParts(parts)
+            parts.append("</" + self.etype + ">")
+        else:
+            INDIBase.xmlParts(self, parts)
     
 
 # Classes to represent the different commands.
 class GetProperties(INDIBase):
-    pass
+    __slots__ = ()
 
 class DefTextVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class DefText(INDIElement):
-    pass
+    __slots__ = ()
 
 class DefNumberVector(INDIVector):
-    pass
+    __slots__ = ()
 
-class DefNumber(INDIElement):
-    pass
+class DefNumber(INDINumber):
+    __slots__ = ()
 
 class DefSwitchVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class DefSwitch(INDIElement):
-    pass
+    __slots__ = ()
 
 class DefLightVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class DefLight(INDIElement):
-    pass
+    __slots__ = ()
 
 class DefBLOBVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class DefBLOB(INDIBase):
-    pass
+    __slots__ = ()
 
 class SetTextVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class SetNumberVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class SetSwitchVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class SetLightVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class SetBLOBVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class Message(INDIBase):
+    __slots__ = ()
 
     def __str__(self):
-        if "message" in self.attr:
-            return INDIBase.__str__(self) + "\n  " + self.attr["message"]
+        if self.hasAttr("message"):
+            return INDIBase.__str__(self) + "\n  " + self.getAttr("message")
         else:
             return INDIBase.__str__(self) + "\n  empty message.\n"
 
 class DelProperty(INDIBase):
-    pass
+    __slots__ = ()
 
 class OneLight(INDIElement):
-    pass
+    __slots__ = ()
 
 class EnableBLOB(INDIElement):
-    pass
+    __slots__ = ()
 
 class NewTextVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class NewNumberVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class NewSwitchVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class NewBLOBVector(INDIVector):
-    pass
+    __slots__ = ()
 
 class OneText(INDIElement):
-    pass
+    __slots__ = ()
 
-class OneNumber(INDIElement):
-    pass
+class OneNumber(INDINumber):
+    __slots__ = ()
 
 class OneSwitch(INDIElement):
-    pass
+    __slots__ = ()
 
 class OneBLOB(INDIElement):
-    
+    """
+    When created from XML from the indiserver the base64 encoded payload
+    is kept as is and only decoded the first time it is needed. The
+    size, format and encoded length are available without decoding.
+
+    If the payload was decoded into a file by the stream decoder the
+    value is read from the file when requested.
+
+    zlib compressed formats (.z, .fits.z) are decompressed as part of
+    decoding, so the value is always the uncompressed data. Use
+    getDataFormat() for the format of the value.
+    """
+    __slots__ = ("encoded", "filename")
+
     def __init__(self, etype, value, attr_dict, etree):
-        INDIElement.__init__(self, etype, None, attr_dict, etree)
+        INDIBase.__init__(self, etype, None, attr_dict, etree)
+        self.encoded = None
+        self.filename = None
+        self.value = value
 
-        #
-        # Convert value to bytes from base64 if this object
-        # was created from XML from the indiserver.
-        #
+        # The base64 decoder ignores the whitespace around the
+        # payload, so we don't need to make a stripped copy.
         if etree is not None:
-            self.value = base64.standard_b64decode(self.value)
-    
+            self.encoded = etree.text
+            self.value = None
+            if self.encoded is None:
+                self.encoded = ""
+
     def __str__(self):
-        return INDIBase.__str__(self) + "\n    " + self.attr["size"] + "\n    " + self.attr["format"] + "\n"
+        return INDIBase.__str__(self) + "\n    " + self.getAttr("size") + "\n    " + self.getAttr("format") + "\n"
+
+    def decodeBLOBs(self):
+        """
+        Convert value to bytes from base64, if this has not already been done.
+        """
+        if self.encoded is not None:
+            self.value = base64.standard_b64decode(self.encoded)
+            self.encoded = None
+            if self.isCompressed():
+                self.value = zlib.decompress(self.value, bufsize = max(self.getSize(), 1))
+
+    def getEncodedLength(self):
+        """
+        The length of the base64 encoded payload.
+        """
+        if self.encoded is not None:
+            return len(self.encoded)
+        if self.value is None:
+            return 4 * ((os.path.getsize(self.filename) + 2) // 3)
+        return 4 * ((len(self.value) + 2) // 3)
+
+    def getDataFormat(self):
+        """
+        The format of the value, i.e. without the compression suffix.
+        """
+        return uncompressedFormat(self.getAttr("format"))
+
+    def getFilename(self):
+        return self.filename
+
+    def getFormat(self):
+        return self.getAttr("format")
+
+    def getSize(self):
+        return int(self.getAttr("size"))
+
+    def getValue(self):
+        self.decodeBLOBs()
+        if self.value is None and self.filename is not None:
+            with open(self.filename, "rb") as fp:
+                self.value = fp.read()
+        return self.value
+
+    def setFilename(self, filename):
+        self.encoded = None
+        self.filename = filename
+        self.value = None
+
+    def setValue(self, value):
+        self.encoded = None
+        self.value = value
+
+    def isCompressed(self):
+        """
+        True if the payload (as sent) is zlib compressed.
+        """
+        if self.hasAttr("format"):
+            return isCompressedFormat(self.getAttr("format"))
+        return False
+
+    def isDecoded(self):
+        return (self.encoded is None)
+
+    def getText(self):
+        return str(self.getValue())
 
 
 #
@@ -296,8 +580,8 @@ def numberValue(value):
 
         # Check if value is a sexagesimal string.
         try:
-            angle = astropy.coordinates.Angle(value, unit = astropy.units.deg)
-        except:
+            sexagesimal.parseSexagesimal(str(value))
+        except sexagesimal.SexagesimalException:
             raise IndiXMLException(str(value) + " is not a valid number.")
 
     return value
@@ -586,60 +870,121 @@ indi_spec = {
 }
 
 
-def makeINDIFn(indi_type):
+def makeAttrLayouts():
     """
-    Returns an INDI function of the requested type.
+    Set the attribute layout of each INDI class from indi_spec. Classes
+    that are used for several INDI types get the union of the attributes.
     """
-    global indi_spec
-    
-    # Check that the requested type exists.
-    if not indi_type in indi_spec:
-        raise IndiXMLException(indi_type + " is not a valid INDI XML command type.")
+    for type_spec in indi_spec.values():
+        a_class = type_spec["class"]
+        if not "attr_index" in a_class.__dict__:
+            a_class.attr_index = {}
+            a_class.attr_names = []
 
-    type_spec = indi_spec[indi_type]
+        for attr in type_spec.get("attributes", []):
+            xml_name = attr[1]
+            if xml_name is None:
+                xml_name = attr[0]
+            if not xml_name in a_class.attr_index:
+                a_class.attr_index[xml_name] = len(a_class.attr_names)
+                a_class.attr_names.append(xml_name)
 
-    # Use indi_type as the XML element type, unless otherwise specified.
-    if not "xml" in type_spec:
-        type_spec["xml"] = indi_type
-    
-    # Function to make the object.
-    def makeObject(fn_arg, fn_attr):
+makeAttrLayouts()
+
+
+class INDIType(object):
+    """
+    An INDI command type compiled from its indi_spec entry, so that
+    creating objects does not have to walk the specification.
+    """
+    def __init__(self, indi_type, type_spec, **kwds):
+        super().__init__(**kwds)
+        self.a_class = type_spec["class"]
+        self.arg_validator = type_spec.get("arg")
+        self.attributes = {}
+        self.indi_type = indi_type
+        self.renames = {}
+        self.required = []
+
+        # Use indi_type as the XML element type, unless otherwise specified.
+        self.xml = type_spec.get("xml", indi_type)
+
+        for attr in type_spec.get("attributes", []):
+            xml_name = attr[1]
+            if xml_name is None:
+                xml_name = attr[0]
+            else:
+                self.renames[attr[0]] = xml_name
+            if attr[2]:
+                self.required.append(attr[0])
+            self.attributes[attr[0]] = (xml_name, attr[3])
+
+        self.required = tuple(self.required)
+        self.required_set = frozenset(self.required)
+
+    def makeObject(self, fn_arg, fn_attr):
+        if fn_attr is None:
+            fn_attr = {}
+
+        # Check that the required attributes are present.
+        if not self.required_set.issubset(fn_attr):
+            for attr_name in self.required:
+                if not attr_name in fn_attr:
+                    raise IndiXMLException(attr_name + " is a required attribute.")
 
         # Check attributes against those in the specification.
-        all_attr = []
         final_attr = {}
-        for attr in type_spec["attributes"]:
-            attr_name = attr[0]
-            all_attr.append(attr_name)
+        for attr_name in fn_attr:
+            if not attr_name in self.attributes:
+                raise IndiXMLException(attr_name + " is not an attribute of " + self.indi_type + ".")
+            [xml_name, validator] = self.attributes[attr_name]
+            final_attr[xml_name] = validator(fn_attr[attr_name])
 
-            # Check if required.
-            if attr[2] and not attr_name in fn_attr:
-                raise IndiXMLException(attr_name + " is a required attribute.")
+        # Make an INDI object of this class.
+        return self.a_class(self.xml, fn_arg, final_attr, None)
 
-            # Check if valid.
-            if attr_name in fn_attr:
-                if attr[1] is None:
-                    attr[1] = attr[0]
-                final_attr[attr[1]] = attr[3](fn_attr[attr_name])
+    def makeUnchecked(self, fn_arg, fn_attr):
+        """
+        Make an INDI object without validating the argument or the
+        attributes, only for use with trusted values.
+        """
+        if fn_attr is None:
+            fn_attr = {}
+        if self.renames:
+            fn_attr = dict([self.renames.get(key, key), fn_attr[key]] for key in fn_attr)
+        return self.a_class(self.xml, fn_arg, fn_attr, None)
 
-        # Check that there are no extra attributes.
-        for attr in fn_attr:
-            if not attr in all_attr:
-                raise IndiXMLException(attr + " is not an attribute of " + indi_type + ".")
 
-        # Make an INDI object of this class.
-        return type_spec["class"](type_spec["xml"], fn_arg, final_attr, None)
+# The compiled INDI command types.
+indi_types = {x : INDIType(x, indi_spec[x]) for x in indi_spec}
+
+
+def makeINDIFn(indi_type):
+    """
+    Returns an INDI function of the requested type.
+
+    The function has an 'unchecked' attribute, a version of the function
+    that skips validation for trusted (internal) callers.
+    """
+    # Check that the requested type exists.
+    if not indi_type in indi_types:
+        raise IndiXMLException(indi_type + " is not a valid INDI XML command type.")
+
+    compiled_type = indi_types[indi_type]
+    makeObject = compiled_type.makeObject
+    makeUnchecked = compiled_type.makeUnchecked
 
     # Check if an argument was expected.
-    if "arg" in type_spec:
+    arg_validator = compiled_type.arg_validator
+    if arg_validator is not None:
 
         def ifunction(arg, indi_attr = None):
             
-            # Check argument with validator function.
-            arg = type_spec["arg"](arg)
+            # Check argument with validator function and create object.
+            return makeObject(arg_validator(arg), indi_attr)
 
-            # Create object.
-            return makeObject(arg, indi_attr)
+        def unchecked(arg, indi_attr = None):
+            return makeUnchecked(arg, indi_attr)
 
     else:
         
@@ -648,9 +993,14 @@ def makeINDIFn(indi_type):
             # Create object.
             return makeObject(None, indi_attr)
 
+        def unchecked(indi_attr = None):
+            return makeUnchecked(None, indi_attr)
+
     # Manipulate some properties of the function so that help, etc. is clearer.
     ifunction.__name__ = indi_type
-    ifunction.__doc__ = type_spec["docs"]  # FIXME: Add arguments dictionary.
+    ifunction.__doc__ = indi_spec[indi_type]["docs"]  # FIXME: Add arguments dictionary.
+    ifunction.unchecked = unchecked
+    unchecked.__name__ = indi_type + "_unchecked"
     
     return ifunction
 
@@ -662,15 +1012,38 @@ def makeINDIFn(indi_type):
 
 # XML parsing of incoming commands.
 
-def parseETree(etree):
-    type_spec = indi_spec[etree.tag]
-    return type_spec["class"](type_spec["xml"], None, None, etree)
+def parseETree(etree, lazy_blobs = False):
+    """
+    If lazy_blobs is True the BLOBs in the message are not decoded
+    until their values are requested.
+    """
+    indi_object = indi_spec[etree.tag]["class"](etree.tag, None, None, etree)
+    if not lazy_blobs:
+        indi_object.decodeBLOBs()
+    return indi_object
 
 def parseINDIXML(xml_string):
     etree = ElementTree.fromstring(xml_string).getroot()
     return parseETree(etree)
 
 
+# BLOB formats.
+
+def isCompressedFormat(blob_format):
+    """
+    True if blob_format (such as ".fits.z") is zlib compressed.
+    """
+    return blob_format.endswith(".z")
+
+def uncompressedFormat(blob_format):
+    """
+    Returns blob_format without the compression suffix, ".fits.z" -> ".fits".
+    """
+    if isCompressedFormat(blob_format):
+        return blob_format[:-len(".z")]
+    return blob_format
+
+
 # Create the functions for generating INDI command objects.
 
 deviceGetProperties = makeINDIFn("deviceGetProperties")
@@ -706,6 +1079,22 @@ oneSwitch = makeINDIFn("oneSwitch")
 oneBLOB = makeINDIFn("oneBLOB")
 
 
+# Convenience functions.
+
+def ccdCompression(device, compress = True):
+    """
+    Ask a camera to send zlib compressed (.fits.z) images, or raw images
+    if compress is False. This uses the standard CCD_COMPRESSION property.
+    """
+    if compress:
+        states = ["On", "Off"]
+    else:
+        states = ["Off", "On"]
+    return newSwitchVector([oneSwitch(states[0], indi_attr = {"name" : "CCD_COMPRESS"}),
+                            oneSwitch(states[1], indi_attr = {"name" : "CCD_RAW"})],
+                           indi_attr = {"name" : "CCD_COMPRESSION", "device" : device})
+
+
 #
 # Simple tests.
 #
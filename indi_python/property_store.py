@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+A client side mirror of the properties of the devices on an indiserver.
+
+The def, set and delProperty messages are applied to the store as they
+arrive, so the current value, state and timestamp of any property (or
+element) can be looked up directly rather than by searching through
+the message stream.
+
+Usage:
+
+store = PropertyStore()
+client.setPropertyStore(store)
+..
+ra = store.getValue("Telescope Simulator", "EQUATORIAL_EOD_COORD", "RA")
+"""
+
+import time
+
+import indi_python.indi_xml as indiXML
+
+
+class PropertyStoreException(Exception):
+    pass
+
+
+class INDIProperty(object):
+    """
+    The current state of a single property.
+    """
+    def __init__(self, device, name, **kwds):
+        super().__init__(**kwds)
+        self.definition = None
+        self.device = device
+        self.elements = {}
+        self.name = name
+        self.state = None
+        self.timestamp = None
+        self.update_time = None
+        self.version = 0
+
+    def getDefinition(self):
+        """
+        The def*Vector message, or None if we have not seen one.
+        """
+        return self.definition
+
+    def getElement(self, name):
+        """
+        The most recent element (def* or one*) with this name.
+        """
+        return self.elements[name]
+
+    def getElementNames(self):
+        return list(self.elements)
+
+    def getState(self):
+        return self.state
+
+    def getTimestamp(self):
+        """
+        The timestamp sent by the device, or None if the device did not
+        send one. getUpdateTime() is the (local) time of the last update.
+        """
+        return self.timestamp
+
+    def getUpdateTime(self):
+        return self.update_time
+
+    def getValue(self, name):
+        return self.elements[name].getValue()
+
+    def getValuesDict(self):
+        return {name : self.elements[name].getValue() for name in self.elements}
+
+    def getVersion(self):
+        """
+        This is incremented every time the property is defined or updated.
+        """
+        return self.version
+
+    def update(self, message):
+        if message.hasAttr("state"):
+            self.state = message.getAttr("state")
+        if message.hasAttr("timestamp"):
+            self.timestamp = message.getAttr("timestamp")
+        for elt in message.getEltList():
+            self.elements[elt.getAttr("name")] = elt
+        self.update_time = time.time()
+        self.version += 1
+
+
+class PropertyStore(object):
+    """
+    Properties are indexed by (device, name). Listeners are called with
+    (event, INDIProperty) where event is one of "define", "update" or
+    "delete".
+    """
+    def __init__(self, **kwds):
+        super().__init__(**kwds)
+        self.listeners = []
+        self.properties = {}
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def apply(self, message):
+        """
+        Apply a single INDI message to the store. Messages that don't
+        change the state of a property are ignored.
+        """
+        if isinstance(message, indiXML.INDIVector) and message.etype.startswith("def"):
+            key = (message.getAttr("device"), message.getAttr("name"))
+
+            # A redefinition replaces the elements, but the version
+            # keeps counting up.
+            if not key in self.properties:
+                self.properties[key] = INDIProperty(key[0], key[1])
+            indi_property = self.properties[key]
+            indi_property.definition = message
+            indi_property.elements = {}
+            indi_property.update(message)
+            self.notify("define", indi_property)
+
+        elif isinstance(message, indiXML.INDIVector) and message.etype.startswith("set"):
+            key = (message.getAttr("device"), message.getAttr("name"))
+
+            # Devices can send set without def, in which case we
+            # only know what is in the set message.
+            if not key in self.properties:
+                self.properties[key] = INDIProperty(key[0], key[1])
+            indi_property = self.properties[key]
+            indi_property.update(message)
+            self.notify("update", indi_property)
+
+        elif isinstance(message, indiXML.DelProperty):
+            device = message.getAttr("device")
+
+            # No name means the whole device.
+            if message.hasAttr("name"):
+                keys = [(device, message.getAttr("name"))]
+            else:
+                keys = [x for x in self.properties if (x[0] == device)]
+
+            for key in keys:
+                self.deleteProperty(key[0], key[1])
+
+    def applyMessages(self, messages):
+        for message in messages:
+            self.apply(message)
+
+    def deleteProperty(self, device, name):
+        """
+        Remove a property from the store, this does nothing if the
+        property does not exist.
+        """
+        indi_property = self.properties.pop((device, name), None)
+        if indi_property is not None:
+            self.notify("delete", indi_property)
+
+    def getDevices(self):
+        return sorted(set([x[0] for x in self.properties]))
+
+    def getProperty(self, device, name):
+        """
+        Returns the INDIProperty, or None if the property does not exist.
+        """
+        return self.properties.get((device, name))
+
+    def getPropertyNames(self, device):
+        return [x[1] for x in self.properties if (x[0] == device)]
+
+    def getState(self, device, name):
+        return self.getRequiredProperty(device, name).getState()
+
+    def getRequiredProperty(self, device, name):
+        try:
+            return self.properties[(device, name)]
+        except KeyError:
+            raise PropertyStoreException("No property " + name + " for device " + device + ".")
+
+    def getTimestamp(self, device, name):
+        return self.getRequiredProperty(device, name).getTimestamp()
+
+    def getValue(self, device, name, element):
+        return self.getRequiredProperty(device, name).getValue(element)
+
+    def getVersion(self, device, name):
+        """
+        Returns 0 if the property does not exist.
+        """
+        indi_property = self.properties.get((device, name))
+        if indi_property is None:
+            return 0
+        return indi_property.getVersion()
+
+    def notify(self, event, indi_property):
+        for listener in self.listeners:
+            listener(event, indi_property)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
@@ -6,141 +6,478 @@ in the context of a PyQt application.
 
 """
 
-from xml.etree import ElementTree
-from PyQt5 import QtCore, QtNetwork
+from PyQt5 import QtCore, QtNetwork, sip
 
 
+import indi_python.indi_stream as indiStream
 import indi_python.indi_xml as indiXML
+import indi_python.send_queue as sendQueue
+import indi_python.session as session
 
 
 class QtINDIClientException(Exception):
     pass
 
 
+def readSocket(a_socket, decoder, verbose):
+    """
+    Read everything that is available on the socket and return the
+    INDI messages that were completed.
+    """
+    # Get message from socket, each chunk is only parsed once and
+    # is not kept after that.
+    messages = []
+    while a_socket.bytesAvailable():
+        data = a_socket.read(2**20)
+        if verbose:
+            print("INDIClient: received " + str(len(data)) + " bytes.")
+        messages.extend(decoder.feed(data))
+
+    if verbose and decoder.hasPartialMessage():
+        print("INDIClient: message is not yet complete.")
+
+    return messages
+
+
+class QtINDIReader(QtCore.QObject):
+    """
+    Reads and decodes the INDI stream in its own thread. Decoded messages 
+    are collected until the GUI thread takes them, so if the GUI falls
+    behind the messages from several reads are coalesced into one batch
+    rather than queueing up one event per read.
+    """
+    batchReady = QtCore.pyqtSignal()
+
+    def __init__(self, a_socket = None, decoder = None, verbose = True, **kwds):
+        super().__init__(**kwds)
+
+        self.decoder = decoder
+        self.mutex = QtCore.QMutex()
+        self.pending = []
+        self.pending_reads = 0
+        self.socket = a_socket
+        self.verbose = verbose
+
+        self.socket.setParent(self)
+        self.socket.readyRead.connect(self.handleReadyRead)
+
+    # These are slots so that they are called in the thread that we are
+    # moved to, plain Python methods would be called in the GUI thread.
+    @QtCore.pyqtSlot()
+    def handleDisconnectRequest(self):
+        self.socket.disconnectFromHost()
+
+    @QtCore.pyqtSlot()
+    def handleReadyRead(self):
+        messages = readSocket(self.socket, self.decoder, self.verbose)
+        if (len(messages) > 0):
+            self.mutex.lock()
+            self.pending.extend(messages)
+            self.pending_reads += 1
+            first_read = (self.pending_reads == 1)
+            self.mutex.unlock()
+
+            # Only signal if the GUI thread has already taken the last batch.
+            if first_read:
+                self.batchReady.emit()
+
+    def takeBatch(self):
+        """
+        Called from the GUI thread, returns [messages, coalesced].
+        """
+        self.mutex.lock()
+        messages = self.pending
+        coalesced = (self.pending_reads > 1)
+        self.pending = []
+        self.pending_reads = 0
+        self.mutex.unlock()
+        return [messages, coalesced]
+
+
+class QtINDIWriter(QtCore.QObject):
+    """
+    Feeds the socket from the send queue, only writing the next data
+    once Qt has written the last, so that Qt's (unbounded) write buffer
+    never holds more than one BLOB upload and control messages can go
+    ahead of the uploads that are still queued.
+    """
+    def __init__(self, a_socket = None, send_mutex = None, send_queue = None, **kwds):
+        super().__init__(**kwds)
+
+        self.send_mutex = send_mutex
+        self.send_queue = send_queue
+        self.socket = a_socket
+
+        self.socket.bytesWritten.connect(self.handleBytesWritten)
+
+    @QtCore.pyqtSlot("qint64")
+    def handleBytesWritten(self, n_bytes):
+        self.writeNext()
+
+    @QtCore.pyqtSlot()
+    def handleSendRequest(self):
+        self.writeNext()
+
+    def writeNext(self):
+        if (self.socket.bytesToWrite() > 0):
+            return
+
+        self.send_mutex.lock()
+        data = self.send_queue.next()
+        self.send_mutex.unlock()
+
+        if data is not None:
+            self.socket.write(data)
+
+
 class QtINDIClient(QtCore.QObject):
+    """
+    If threaded is True the socket reads and XML decoding are done
+    in a separate thread and the messages are delivered to the GUI
+    thread in batches.
+
+    If lazy_blobs is True BLOBs are only decoded when their value is
+    requested.
+
+    read_buffer_size bounds how much data Qt will buffer for us, once
+    it is full Qt stops reading from the socket until we catch up.
+    max_message_size and overflow bound the size of a single message,
+    see INDIStreamDecoder.
+
+    If stream_blobs is True BLOBs are decoded as they arrive, those
+    larger than blob_spill_size are decoded into a file in
+    blob_directory, see INDIStreamDecoder.
+
+    If reconnect is True we reconnect when the connection is lost, with
+    exponential backoff (a session.Backoff), and replay the getProperties
+    and enableBLOB messages that were sent. The reconnected signal is
+    emitted with the reconnect statistics once the property store has
+    been resynchronized, see session.Session.
+
+    Messages are sent through a send queue, control messages are sent
+    before any queued BLOB uploads, see send_queue.SendQueue. Uploads
+    raise QtINDIClientException if there are more than high_water_mark
+    bytes in the queue.
+    """
+    disconnectRequest = QtCore.pyqtSignal()
     received = QtCore.pyqtSignal(object) # Received messages as INDI Python objects.
+    receivedBatch = QtCore.pyqtSignal(object, bool) # A list of received messages, True if the batch was coalesced.
+    reconnected = QtCore.pyqtSignal(object) # A dictionary of reconnect statistics.
+    sendRequest = QtCore.pyqtSignal()
 
     def __init__(self,
                  address = QtNetwork.QHostAddress(QtNetwork.QHostAddress.LocalHost),
                  port = 7624,
                  verbose = True,
+                 threaded = False,
+                 lazy_blobs = False,
+                 read_buffer_size = 2**24,
+                 max_message_size = None,
+                 overflow = "raise",
+                 stream_blobs = False,
+                 blob_spill_size = None,
+                 blob_directory = None,
+                 reconnect = False,
+                 backoff = None,
+                 resync_timeout = 5.0,
+                 high_water_mark = 2**24,
                  **kwds):
         super().__init__(**kwds)
 
-        self.device = None
-        self.message_string = ""
+        self.decoder = indiStream.INDIStreamDecoder(blob_directory = blob_directory,
+                                                    blob_spill_size = blob_spill_size,
+                                                    lazy_blobs = lazy_blobs,
+                                                    max_message_size = max_message_size,
+                                                    overflow = overflow,
+                                                    stream_blobs = stream_blobs)
+        self.address = address
+        self.auto_reconnect = reconnect
+        self.backoff = backoff
+        self.closing = False
+        self.port = port
+        self.property_store = None
+        self.read_buffer_size = read_buffer_size
+        self.reader = None
+        self.reader_thread = None
+        self.send_mutex = QtCore.QMutex()
+        self.send_queue = sendQueue.SendQueue(high_water_mark = high_water_mark)
+        self.session = session.Session(resync_timeout = resync_timeout)
+        self.threaded = threaded
         self.verbose = verbose
+        self.writer = None
 
-        # Create socket.
-        self.socket = QtNetwork.QTcpSocket()
-        self.socket.disconnected.connect(self.handleDisconnect)
-        self.socket.readyRead.connect(self.handleReadyRead)
+        if self.backoff is None:
+            self.backoff = session.Backoff()
 
         # Connect to socket.
+        self.socket = self.makeSocket()
         self.socket.connectToHost(address, port)
         if not self.socket.waitForConnected():
             raise QtINDIClientException("Cannot connect to indiserver at " + address + ", port " + str(port))
+        self.startReading()
 
     def disconnect(self):
+        self.closing = True
         if self.socket is not None:
-            self.socket.disconnectFromHost()
-            
-    def handleDisconnect(self):
-        self.socket = None
+            if self.reader is not None:
+                self.disconnectRequest.emit()
+            else:
+                self.socket.disconnectFromHost()
 
-    def handleReadyRead(self):
+    def emitMessages(self, messages, coalesced):
+        if self.property_store is not None:
+            self.property_store.applyMessages(messages)
 
-        # Add starting tag if this is new message.
-        if (len(self.message_string) == 0):
-            self.message_string = "<data>"
-            
-        # Get message from socket.
-        while self.socket.bytesAvailable():
+        if self.session.apply(messages):
+            self.reconnected.emit(self.session.getStats())
 
-            # FIXME: This does not work with Python2.
-            tmp = str(self.socket.read(1000000), "ascii")
-            self.message_string += tmp
+        if (len(messages) > 0):
+            self.receivedBatch.emit(messages, coalesced)
+            for xml_message in messages:
+                self.received.emit(xml_message)
 
-        # Add closing tag.
-        self.message_string += "</data>"
+    def handleBatchReady(self):
+        [messages, coalesced] = self.reader.takeBatch()
+        if self.verbose and coalesced:
+            print("INDIClient: coalesced batch of " + str(len(messages)) + " messages.")
+        self.emitMessages(messages, coalesced)
 
-        # Try and parse the message.
-        try:
+    def handleDisconnect(self):
+        # This is called from the socket's disconnected signal, so it (and
+        # the writer, its child) can't be deleted until we are back in the
+        # event loop. In threaded mode they are children of the reader,
+        # which is deleted when the reader thread finishes.
+        if self.reader_thread is not None:
+            self.disconnectRequest.disconnect(self.reader.handleDisconnectRequest)
+            self.sendRequest.disconnect(self.writer.handleSendRequest)
+            self.reader_thread.quit()
+            self.reader_thread.wait()
+            self.reader_thread = None
+            self.reader = None
+        else:
+            self.socket.deleteLater()
+        self.socket = None
+        self.writer = None
+
+        self.decoder.reset()
+        self.session.disconnected()
+        if self.auto_reconnect and not self.closing:
+            self.backoff.reset()
+            self.scheduleReconnect()
+
+    def handleReadyRead(self):
+        self.emitMessages(readSocket(self.socket, self.decoder, self.verbose), False)
+
+    def handleReconnectState(self, state):
+        if (state == QtNetwork.QAbstractSocket.UnconnectedState):
             if self.verbose:
-                print("INDIClient: message length " + str(len(self.message_string)) + "bytes.")
-            messages = ElementTree.fromstring(self.message_string)
-            self.message_string = ""
-            for message in messages:
-                xml_message = indiXML.parseETree(message)
-                
-                # Filter message is self.device is not None.
-                if self.device is not None:
-                    if (self.device == xml_message.getAttr("device")):
-                        self.received.emit(xml_message)
-
-                # Otherwise just send them all.
-                else:
-                    self.received.emit(xml_message)
-
-        # Message is incomplete, remove </data> and wait..
-        except ElementTree.ParseError:
+                print("INDIClient: reconnect failed, " + self.socket.errorString())
+            self.socket.deleteLater()
+            self.socket = None
+            self.scheduleReconnect()
+
+    def handleReconnectTimer(self):
+        if self.closing:
+            return
+        self.socket = self.makeSocket()
+        self.socket.connected.connect(self.handleReconnected)
+        self.socket.stateChanged.connect(self.handleReconnectState)
+        self.socket.connectToHost(self.address, self.port)
+
+    def handleReconnected(self):
+        if self.verbose:
+            print("INDIClient: reconnected.")
+        self.socket.stateChanged.disconnect(self.handleReconnectState)
+        self.startReading()
+
+        # Ask for the same properties (and BLOBs) as before.
+        self.sendMessages(self.session.getReplay())
+        self.session.reconnected(self.property_store)
+        if self.session.isReady():
+            self.reconnected.emit(self.session.getStats())
+        else:
+            QtCore.QTimer.singleShot(int(self.session.resync_timeout * 1000), self.handleResyncTimeout)
+
+    def handleResyncTimeout(self):
+        if self.session.checkTimeout():
+            self.reconnected.emit(self.session.getStats())
+
+    def makeSocket(self):
+        # The socket belongs to us (not Python), so that we can drop it in
+        # its own signals and delete it later.
+        a_socket = QtNetwork.QTcpSocket(self)
+        a_socket.setReadBufferSize(self.read_buffer_size)
+        a_socket.disconnected.connect(self.handleDisconnect)
+        return a_socket
+
+    def scheduleReconnect(self):
+        delay = self.backoff.nextDelay()
+        if delay is None:
             if self.verbose:
-                print("INDIClient: message is not yet complete.")
-            self.message_string = self.message_string[:-7]
+                print("INDIClient: giving up on reconnecting.")
+            return
+        QtCore.QTimer.singleShot(int(delay * 1000), self.handleReconnectTimer)
+
+    def getReconnectStats(self):
+        """
+        See session.Session.getStats().
+        """
+        return self.session.getStats()
 
     def setDevice(self, device = None):
-        self.device = device
+        """
+        Only emit messages from this device, None for all devices.
+        """
+        self.decoder.setDevice(device)
+
+    def setPropertyStore(self, property_store = None):
+        """
+        Keep property_store (a PropertyStore) up to date with all the
+        messages that we receive. This is always done in the GUI thread.
+        """
+        self.property_store = property_store
+
+    def subscribe(self, callback, device = None, name = None, etype = None):
+        """
+        Subscribe to messages, see INDIStreamDecoder.subscribe(). Once there
+        are subscriptions only the messages that match them are emitted.
+
+        Note that in threaded mode callback is called in the reader thread,
+        use the received signals to get messages in the GUI thread.
+        """
+        self.decoder.subscribe(callback, device = device, name = name, etype = etype)
+
+    def unsubscribe(self, callback, device = None, name = None, etype = None):
+        self.decoder.unsubscribe(callback, device = device, name = name, etype = etype)
 
     def sendMessage(self, indi_command):
-        if (self.socket.state() == QtNetwork.QAbstractSocket.ConnectedState):
-            self.socket.write(indi_command.toXML() + b'\n')
-        else:
+        self.sendMessages([indi_command])
+
+    def sendMessages(self, indi_commands):
+        """
+        Queue several messages, they are written together once the
+        socket is ready. indi_commands can be any iterable.
+        """
+        indi_commands = list(indi_commands)
+        for indi_command in indi_commands:
+            self.session.record(indi_command)
+
+        if self.writer is None:
             raise QtINDIClientException("Socket is not connected.")
 
+        # Only BLOB uploads are limited, so that control messages
+        # such as aborts are never held up by them.
+        uploads = any(isinstance(x, indiXML.NewBLOBVector) for x in indi_commands)
+
+        self.send_mutex.lock()
+        try:
+            if uploads and self.send_queue.isFull():
+                raise QtINDIClientException("Send queue is full, " + str(self.send_queue.getSize()) + " bytes.")
+            self.send_queue.put(indi_commands)
+        finally:
+            self.send_mutex.unlock()
+
+        if self.reader is not None:
+            self.sendRequest.emit()
+        else:
+            self.writer.handleSendRequest()
+
+    def sendQueueSize(self):
+        """
+        The number of bytes waiting in the send queue.
+        """
+        return self.send_queue.getSize()
+
+    def startReading(self):
+        # Don't delay small control messages, we do our own coalescing.
+        self.socket.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+        self.writer = QtINDIWriter(a_socket = self.socket,
+                                   send_mutex = self.send_mutex,
+                                   send_queue = self.send_queue,
+                                   parent = self.socket)
+
+        # Hand the socket (and writer) over to the reader thread.
+        if self.threaded:
+            self.reader = QtINDIReader(a_socket = self.socket,
+                                       decoder = self.decoder,
+                                       verbose = self.verbose)
+            self.reader.batchReady.connect(self.handleBatchReady)
+            self.disconnectRequest.connect(self.reader.handleDisconnectRequest)
+            self.sendRequest.connect(self.writer.handleSendRequest)
+
+            self.reader_thread = QtCore.QThread()
+            self.reader.moveToThread(self.reader_thread)
+
+            # The reader (with the socket and writer) is deleted in its own
+            # thread once that finishes, never by Python from this thread.
+            self.reader_thread.finished.connect(self.reader.deleteLater)
+            sip.transferto(self.reader, None)
+            self.reader_thread.start()
+        else:
+            self.socket.readyRead.connect(self.handleReadyRead)
+
 
 if (__name__ == "__main__"):
 
+    import socket
     import sys
-    import time
-    
-    from PyQt5 import QtWidgets
-
-    
-    class Widget(QtWidgets.QWidget):
-
-        def __init__(self):
-            QtWidgets.QWidget.__init__(self)
-
-            self.client = INDIClient()
-            self.client.received.connect(self.handleReceived)
-
-        def handleReceived(self, message):
-            print(message)
-
-        def send(self, message):
-            self.client.send(message)
-
-    app = QtWidgets.QApplication(sys.argv)
-    widget = Widget()
-    widget.show()
-
-    # Get a list of devices.
-    widget.send(indiXML.clientGetProperties(indi_attr = {"version" : "1.0"}))
-    time.sleep(1)
-
-    # Connect to the CCD simulator.
-    widget.send(indiXML.newSwitchVector([indiXML.oneSwitch("On", indi_attr = {"name" : "CONNECT"})],
-                                        indi_attr = {"name" : "CONNECTION", "device" : "CCD Simulator"}))
-    time.sleep(1)
-
-    if True:
-        # Enable BLOB mode.
-        widget.send(indiXML.enableBLOB("Also", indi_attr = {"device" : "CCD Simulator"}))
-        time.sleep(1)
-        
-        # Request image.
-        widget.send(indiXML.newNumberVector([indiXML.oneNumber(1, indi_attr = {"name" : "CCD_EXPOSURE_VALUE"})],
-                                            indi_attr = {"name" : "CCD_EXPOSURE", "device" : "CCD Simulator"}))
-        time.sleep(1)
-    
-    sys.exit(app.exec_())
+    import threading
+
+    #
+    # A test against a fake INDI server on the loopback interface. In
+    # threaded mode the decoding and the writes should not happen in
+    # the GUI thread.
+    #
+    def fakeServer(server_socket):
+        """
+        Answers each getProperties with a setNumberVector.
+        """
+        [a_socket, address] = server_socket.accept()
+        decoder = indiStream.INDIStreamDecoder()
+        while True:
+            data = a_socket.recv(2**16)
+            if not data:
+                break
+            for message in decoder.feed(data):
+                if isinstance(message, indiXML.GetProperties):
+                    reply = indiXML.setNumberVector([indiXML.oneNumber(1.0, indi_attr = {"name" : "VALUE"})],
+                                                    indi_attr = {"device" : "Fake Device",
+                                                                 "name" : "FAKE_PROPERTY",
+                                                                 "state" : "Ok"})
+                    a_socket.sendall(reply.toXML() + b'\n')
+        a_socket.close()
+
+    app = QtCore.QCoreApplication(sys.argv)
+
+    server_socket = socket.socket()
+    server_socket.bind(("127.0.0.1", 0))
+    server_socket.listen(1)
+    server_thread = threading.Thread(target = fakeServer, args = (server_socket,), daemon = True)
+    server_thread.start()
+
+    client = QtINDIClient(address = "127.0.0.1",
+                          port = server_socket.getsockname()[1],
+                          threaded = True,
+                          verbose = False)
+
+    # Subscribers are called in the thread that decodes the messages.
+    decode_threads = []
+    client.subscribe(lambda message: decode_threads.append(QtCore.QThread.currentThread()))
+
+    def handleReceived(message):
+        print("received", message.etype, message.getAttr("name"))
+        assert not (decode_threads[0] is app.thread()), "Decoded in the GUI thread."
+        assert not (client.writer.thread() is app.thread()), "Writing in the GUI thread."
+        print("decoded and written in the reader thread")
+        client.disconnect()
+        QtCore.QTimer.singleShot(100, app.quit)
+
+    client.received.connect(handleReceived)
+    client.sendMessage(indiXML.clientGetProperties(indi_attr = {"version" : "1.7"}))
+
+    # Give up if the message doesn't make the round trip.
+    QtCore.QTimer.singleShot(2000, app.quit)
+    app.exec_()
+    server_socket.close()
+    if not decode_threads:
+        sys.exit("No reply from the fake server.")
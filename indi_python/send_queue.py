@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+An output queue for INDI messages.
+
+Control messages (everything except BLOB uploads) are coalesced into a
+single buffer that is always sent before any BLOB upload that is still
+waiting. As INDI has no framing a message can't be split, so a control
+message may still have to wait for the upload that is being sent, but
+it never waits behind a queue of them.
+"""
+
+import collections
+
+import indi_python.indi_xml as indiXML
+
+
+class SendQueue(object):
+
+    def __init__(self, high_water_mark = 2**24, **kwds):
+        """
+        high_water_mark - The number of (encoded) bytes in the queue
+            at which isFull() becomes True. This is checked before a
+            message is added, so a single large message always fits.
+        """
+        super().__init__(**kwds)
+        self.blobs = collections.deque()
+        self.control = bytearray()
+        self.high_water_mark = high_water_mark
+        self.size = 0
+
+    def clear(self):
+        self.blobs.clear()
+        del self.control[:]
+        self.size = 0
+
+    def getSize(self):
+        """
+        The number of bytes waiting to be sent.
+        """
+        return self.size
+
+    def isEmpty(self):
+        return (self.size == 0)
+
+    def isFull(self):
+        return (self.size >= self.high_water_mark)
+
+    def next(self):
+        """
+        Remove and return the next data to send, or None if the queue
+        is empty. This is all of the control messages, or one BLOB upload.
+        """
+        if self.control:
+            data = bytes(self.control)
+            del self.control[:]
+        elif self.blobs:
+            data = self.blobs.popleft()
+        else:
+            return None
+        self.size -= len(data)
+        return data
+
+    def put(self, indi_elts):
+        """
+        Encode and queue a list of messages, returns the number of
+        bytes that were added.
+        """
+        start_size = self.size
+        for indi_elt in indi_elts:
+            if isinstance(indi_elt, indiXML.NewBLOBVector):
+                data = bytearray()
+                indi_elt.writeXML(data)
+                data += b'\n'
+                self.blobs.append(data)
+                self.size += len(data)
+            else:
+                n_bytes = len(self.control)
+                indi_elt.writeXML(self.control)
+                self.control += b'\n'
+                self.size += len(self.control) - n_bytes
+        return self.size - start_size
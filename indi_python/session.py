@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Support for reconnecting to an indiserver.
+
+A Session records the getProperties and enableBLOB messages that a
+client has sent, so that after a reconnect only the same devices and
+properties are asked for again (rather than everything). It then
+reconciles the replies against the PropertyStore. The session is
+'ready' once every property that was in the store (within the replayed
+scopes) has been defined again. Properties that are not redefined
+within the resync timeout are deleted from the store.
+"""
+
+import time
+
+import indi_python.indi_xml as indiXML
+
+
+class Backoff(object):
+    """
+    Exponential backoff between reconnection attempts.
+    """
+    def __init__(self, initial = 0.5, maximum = 30.0, factor = 2.0, max_attempts = None, **kwds):
+        """
+        max_attempts - Give up after this many attempts, None to keep trying.
+        """
+        super().__init__(**kwds)
+        self.attempts = 0
+        self.factor = factor
+        self.initial = initial
+        self.max_attempts = max_attempts
+        self.maximum = maximum
+
+    def nextDelay(self):
+        """
+        Returns the time to wait before the next attempt, or None if we
+        should give up.
+        """
+        if (self.max_attempts is not None) and (self.attempts >= self.max_attempts):
+            return None
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+class Session(object):
+
+    def __init__(self, resync_timeout = 5.0, **kwds):
+        super().__init__(**kwds)
+        self.connect_time = None
+        self.disconnect_time = None
+        self.expected = None
+        self.last_connect_time = None
+        self.last_ready_time = None
+        self.property_store = None
+        self.reconnects = 0
+        self.resync_timeout = resync_timeout
+        self.scopes = {}
+        self.stale = []
+
+    def apply(self, messages):
+        """
+        Called with the messages that were received, returns True if the
+        session just became ready.
+        """
+        if self.expected is None:
+            return False
+
+        for message in messages:
+            if isinstance(message, indiXML.INDIVector) and message.etype.startswith("def"):
+                self.expected.discard((message.getAttr("device"), message.getAttr("name")))
+
+        if not self.expected:
+            self.finishResync()
+            return True
+        return False
+
+    def checkTimeout(self):
+        """
+        Returns True if the resync timed out, in which case the session
+        is now ready.
+        """
+        if self.expected is None:
+            return False
+        if ((time.monotonic() - self.connect_time) > self.resync_timeout):
+            self.finishResync()
+            return True
+        return False
+
+    def disconnected(self):
+        """
+        Called when the connection is lost.
+        """
+        self.disconnect_time = time.monotonic()
+        self.expected = None
+
+    def finishResync(self):
+        """
+        Delete the properties that were not redefined.
+        """
+        self.stale = sorted(self.expected)
+        if self.property_store is not None:
+            for [device, name] in self.stale:
+                self.property_store.deleteProperty(device, name)
+        self.expected = None
+        self.last_ready_time = time.monotonic() - self.connect_time
+
+    def getReplay(self):
+        """
+        Returns the messages to send after reconnecting.
+        """
+        return list(self.scopes.values())
+
+    def getStats(self):
+        """
+        Returns a dictionary with the statistics of the last reconnect.
+
+        reconnects - The number of reconnects.
+        connect_time - Seconds from disconnect to being connected again.
+        ready_time - Seconds from being connected to being ready, None
+                     while we are still resynchronizing.
+        stale - The (device, name) of the properties that were deleted
+                because they were not redefined.
+        """
+        return {"reconnects" : self.reconnects,
+                "connect_time" : self.last_connect_time,
+                "ready_time" : self.last_ready_time,
+                "stale" : self.stale}
+
+    def isReady(self):
+        return (self.expected is None)
+
+    def record(self, message):
+        """
+        Called with each message that the client sends.
+        """
+        if isinstance(message, indiXML.GetProperties) or isinstance(message, indiXML.EnableBLOB):
+            device = message.getAttr("device") if message.hasAttr("device") else None
+            name = message.getAttr("name") if message.hasAttr("name") else None
+            key = (message.etype, device, name)
+
+            # Move repeated scopes to the end so that the replay
+            # is in the same order as the original requests.
+            self.scopes.pop(key, None)
+            self.scopes[key] = message
+
+    def reconnected(self, property_store = None):
+        """
+        Called once we are connected again and have sent the replay
+        messages.
+        """
+        self.connect_time = time.monotonic()
+        self.last_connect_time = self.connect_time - self.disconnect_time
+        self.last_ready_time = None
+        self.property_store = property_store
+        self.reconnects += 1
+        self.stale = []
+
+        # The properties that we expect to be defined again.
+        self.expected = set()
+        if property_store is not None:
+            for key in list(self.scopes):
+                [etype, device, name] = key
+                if (etype != "getProperties"):
+                    continue
+                if device is None:
+                    devices = property_store.getDevices()
+                else:
+                    devices = [device]
+                for a_device in devices:
+                    for a_name in property_store.getPropertyNames(a_device):
+                        if (name is None) or (name == a_name):
+                            self.expected.add((a_device, a_name))
+
+        if not self.expected:
+            self.finishResync()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Parsing and formatting of INDI sexagesimal numbers.
+
+INDI allows numbers to be sent in sexagesimal form, with the fields
+separated by colons, semicolons or blanks, "12:34:56.7", "-05 30 00",
+"12;30". This is a small native parser so that we don't need to
+import astropy just to check these. astropy is only imported (if it is
+available) as a fallback for other angle formats, such as "12h34m56s".
+"""
+
+import functools
+
+
+class SexagesimalException(Exception):
+    pass
+
+
+def formatSexagesimal(value, precision = 1, separator = ":"):
+    """
+    Format a number as a sexagesimal string, 12.5824 -> "12:34:56.6".
+    precision is the number of decimal places for the seconds.
+    """
+    sign = ""
+    if (value < 0.0):
+        sign = "-"
+
+    # Round first so that 59.99 seconds doesn't become "60.0".
+    seconds = round(abs(value) * 3600.0, precision)
+    [minutes, seconds] = divmod(seconds, 60.0)
+    [degrees, minutes] = divmod(minutes, 60.0)
+
+    if (precision > 0):
+        seconds_str = "{0:0{1}.{2}f}".format(seconds, precision + 3, precision)
+    else:
+        seconds_str = "{0:02d}".format(int(seconds))
+    return sign + "{0:d}{1}{2:02d}{1}{3}".format(int(degrees), separator, int(minutes), seconds_str)
+
+@functools.lru_cache(maxsize = 4096)
+def parseSexagesimal(string, use_astropy = True):
+    """
+    Convert a sexagesimal (or plain number) string to a float, the
+    results are cached as the same values tend to be sent repeatedly.
+
+    If the string is not in INDI sexagesimal format and use_astropy is
+    True then we'll see if astropy can make sense of it.
+    """
+    fields = string.replace(":", " ").replace(";", " ").split()
+    try:
+        if not (1 <= len(fields) <= 3):
+            raise ValueError
+        value = 0.0
+        scale = 1.0
+        for i, field in enumerate(fields):
+            if (i > 0) and (field[0] in "+-"):
+                raise ValueError
+            value += abs(float(field))/scale
+            scale *= 60.0
+
+    except ValueError:
+        if use_astropy:
+            return parseAstropy(string)
+        raise SexagesimalException(string + " is not a valid sexagesimal number.")
+
+    if fields[0].startswith("-"):
+        value = -value
+    return value
+
+def parseAstropy(string):
+    """
+    Use astropy (if available) to convert an angle string to degrees.
+    """
+    try:
+        import astropy.coordinates
+        import astropy.units
+    except ImportError:
+        raise SexagesimalException(string + " is not a valid sexagesimal number.")
+
+    try:
+        return astropy.coordinates.Angle(string, unit = astropy.units.deg).degree
+    except Exception:
+        raise SexagesimalException(string + " is not a valid sexagesimal number.")
+
+def parseSexagesimalArray(values):
+    """
+    Convert an array of sexagesimal strings to a NumPy array of floats.
+    Each distinct string is only parsed once.
+    """
+    import numpy
+
+    values = numpy.asarray(values)
+    if values.dtype.kind in "biuf":
+        return values.astype(numpy.float64)
+
+    [unique, inverse] = numpy.unique(values, return_inverse = True)
+    parsed = numpy.array([parseSexagesimal(str(x)) for x in unique], dtype = numpy.float64)
+    return parsed[inverse].reshape(values.shape)
+
+
+if (__name__ == "__main__"):
+
+    for string in ["12:34:56.7", "-05 30 00", "12;30", "45", "-0:30", "23:59:59.99"]:
+        value = parseSexagesimal(string, use_astropy = False)
+        print(string, value, formatSexagesimal(value))
@@ -1,102 +1,565 @@
 #!/usr/bin/env python
 """
 A very basic fits file parser. This only handles fits file
-that contain a single (gray-scale) image. It was designed
+that contain a single image, which can have any number of axes
+(an RGB image is 3 x NAXIS2 x NAXIS1). It was designed
 primarily for the purpose of handling images from an 
 INDI server.
 
+Images can also be written, either from a numpy array with
+writeFits() or unchanged (e.g. a BLOB) with writeRaw().
+
 Hazen 11/16
 """
 
+import os
+import re
+import tempfile
+
 import numpy
 
 
+# FITS files are made of 2880 byte blocks, the header is 80 byte cards.
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Keywords that can appear many times and don't have a value.
+COMMENTARY_KEYWORDS = frozenset([b'COMMENT ', b'HISTORY ', b'CONTINUE', b'        '])
+
+END_KEYWORD = b'END     '
+
+# The (big endian) data type for each BITPIX.
+BITPIX_TYPES = {8 : numpy.dtype('>u1'),
+                16 : numpy.dtype('>i2'),
+                32 : numpy.dtype('>i4'),
+                64 : numpy.dtype('>i8'),
+                -32 : numpy.dtype('>f4'),
+                -64 : numpy.dtype('>f8')}
+
+# The BZERO of the unsigned integer conventions (signed for BITPIX 8),
+# and the data type of the physical values.
+UNSIGNED_CONVENTIONS = {8 : [-2**7, numpy.dtype('i1')],
+                        16 : [2**15, numpy.dtype('u2')],
+                        32 : [2**31, numpy.dtype('u4')],
+                        64 : [2**63, numpy.dtype('u8')]}
+
+# The [BITPIX, BZERO] for each numpy data type, the sign bit is
+# flipped if BZERO is not 0.
+NUMPY_TYPES = {"u1" : [8, 0],
+               "i1" : [8, -2**7],
+               "i2" : [16, 0],
+               "u2" : [16, 2**15],
+               "i4" : [32, 0],
+               "u4" : [32, 2**31],
+               "i8" : [64, 0],
+               "u8" : [64, 2**63],
+               "f4" : [-32, 0],
+               "f8" : [-64, 0]}
+
+# A quoted string, a doubled quote is a quote in the string.
+STRING_VALUE = re.compile(r"\s*'((?:[^']|'')*)'\s*(?:/(.*))?$")
+
+# Keywords that describe the data, these are set by the writer.
+STRUCTURAL_KEYWORDS = re.compile(r"(SIMPLE|BITPIX|NAXIS\d*|EXTEND|BZERO|BSCALE)$")
+
+# The only way to read the umask also sets it, for the whole process, so
+# this is done once at import rather than while other threads are running.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
 class SimpleFitsException(Exception):
     pass
 
 
+def getFitsType(np_data):
+    """
+    Returns [BITPIX, BZERO] for a numpy array.
+    """
+    key = np_data.dtype.kind + str(np_data.dtype.itemsize)
+    if not key in NUMPY_TYPES:
+        raise SimpleFitsException("Can't write " + str(np_data.dtype) + " data as FITS.")
+    return NUMPY_TYPES[key]
+
+
+def imageBuffers(np_data, chunk_size = 2**22):
+    """
+    A generator of the (big endian) image data to write. The data is used
+    as is if possible, otherwise it is converted a chunk at a time into a
+    reused buffer, so each buffer must be written before the next one is
+    requested.
+    """
+    [bitpix, bzero] = getFitsType(np_data)
+    fits_type = BITPIX_TYPES[bitpix]
+    data = np_data.reshape(-1)
+
+    if (bzero == 0) and (data.dtype == fits_type):
+        yield memoryview(data).cast("B")
+        return
+
+    n_chunk = max(1, chunk_size // fits_type.itemsize)
+    chunk = numpy.empty(min(n_chunk, data.size), dtype = fits_type)
+    unsigned_type = numpy.dtype("u" + str(fits_type.itemsize))
+    sign_bit = unsigned_type.type(1 << (8 * fits_type.itemsize - 1))
+    for start in range(0, data.size, n_chunk):
+        src = data[start:start + n_chunk]
+        dst = chunk[:src.size]
+
+        # The sign bit flip and byte swap are done in a single pass.
+        if (bzero != 0):
+            numpy.bitwise_xor(src.view(unsigned_type.newbyteorder(src.dtype.byteorder)),
+                              sign_bit,
+                              out = dst.view(unsigned_type.newbyteorder(">")))
+        else:
+            numpy.copyto(dst, src)
+        yield memoryview(dst).cast("B")
+
+
+def makeCard(keyword, value = None, comment = None):
+    """
+    Returns an 80 byte header card. For COMMENT and HISTORY cards the
+    value is the text.
+    """
+    if (len(keyword) > 8):
+        raise SimpleFitsException("Keyword " + keyword + " is longer than 8 characters.")
+
+    if keyword in ["COMMENT", "HISTORY", ""]:
+        card = "{0:8s}{1}".format(keyword, value)
+    else:
+        if isinstance(value, (bool, numpy.bool_)):
+            field = "{0:>20s}".format("T" if value else "F")
+        elif isinstance(value, (int, numpy.integer)):
+            field = "{0:>20d}".format(value)
+        elif isinstance(value, (float, numpy.floating)):
+            if not numpy.isfinite(value):
+                raise SimpleFitsException("Keyword " + keyword + " value " + str(value) + " is not finite.")
+            field = "{0:>20s}".format(repr(float(value)).upper())
+        elif isinstance(value, str):
+            field = "'{0:8s}'".format(value.replace("'", "''"))
+        elif value is None:
+            field = ""
+        else:
+            raise SimpleFitsException("Keyword " + keyword + " has an unsupported value type " + str(type(value)) + ".")
+
+        card = "{0:8s}= {1}".format(keyword, field)
+        if (len(card) > CARD_SIZE):
+            raise SimpleFitsException("Keyword " + keyword + " value is too long.")
+        if comment is not None:
+            card += " / " + comment
+
+    return card[:CARD_SIZE].ljust(CARD_SIZE).encode("ascii")
+
+
+def makeHeader(np_data, keywords = None):
+    """
+    Returns the header for an image, padded to a whole number of blocks.
+
+    keywords - Additional keywords, either a FitsHeader, a dictionary or
+        a list of [keyword, value] or [keyword, value, comment]. Keywords
+        that describe the data (BITPIX, NAXIS, etc.) are ignored.
+    """
+    [bitpix, bzero] = getFitsType(np_data)
+    cards = [makeCard("SIMPLE", True, "conforms to FITS standard"),
+             makeCard("BITPIX", bitpix),
+             makeCard("NAXIS", np_data.ndim)]
+    for [i, size] in enumerate(reversed(np_data.shape)):
+        cards.append(makeCard("NAXIS" + str(i + 1), size))
+    if (bzero != 0):
+        cards.append(makeCard("BZERO", bzero))
+        cards.append(makeCard("BSCALE", 1))
+
+    if isinstance(keywords, FitsHeader):
+        for keyword in keywords:
+            if not STRUCTURAL_KEYWORDS.match(keyword):
+                cards.append(keywords.getCard(keyword))
+        cards.extend(keywords.getCommentaryCards())
+
+    elif keywords is not None:
+        if isinstance(keywords, dict):
+            keywords = keywords.items()
+        for keyword in keywords:
+            if not STRUCTURAL_KEYWORDS.match(keyword[0]):
+                cards.append(makeCard(*keyword))
+
+    cards.append(END_KEYWORD.ljust(CARD_SIZE))
+    header = b''.join(cards)
+    return header + b' ' * (-len(header) % BLOCK_SIZE)
+
+
 def parseValue(string):
     """
-    Try to convert a numeric string to an integer or a float.
+    Convert a (stripped) FITS value to a Python value. Empty values
+    are None, T and F are booleans, D exponents are allowed and
+    quoted strings have their quotes removed.
     """
+    if not string:
+        return None
+    if (string == "T"):
+        return True
+    if (string == "F"):
+        return False
     try:
         return int(string)
     except ValueError:
+        pass
+    try:
+        return float(string.replace("D", "E").replace("d", "e"))
+    except ValueError:
+        pass
+    if string.startswith("(") and string.endswith(")"):
         try:
-            return float(string)
-        except ValueError:
-            return string[1:-1]
+            [real, imag] = string[1:-1].split(",")
+            return complex(parseValue(real.strip()), parseValue(imag.strip()))
+        except (TypeError, ValueError):
+            pass
+    if string.startswith("'"):
+        return string[1:-1].replace("''", "'").rstrip()
+    return string
 
-        
-class FitsImage(object):
 
-    def __init__(self, fits_name = None, fits_string = None, verbose = True):
-        self.keywords = {}
-        self.np_data = None
+def parseValueField(field):
+    """
+    Split the value field of a card into [value, comment]. Slashes
+    in strings are not comments.
+    """
+    match = STRING_VALUE.match(field)
+    if match is not None:
+        [value, comment] = match.groups()
+        value = value.replace("''", "'").rstrip()
+    else:
+        [value, sep, comment] = field.partition("/")
+        value = parseValue(value.strip())
+        if not sep:
+            comment = None
+
+    if comment is not None:
+        comment = comment.strip()
+    return [value, comment]
+
+
+def toKey(keyword):
+    """
+    Convert a keyword to the form used in the FitsHeader index.
+    """
+    return keyword.encode("ascii").ljust(8)
 
-#        if fits_name is None and fits_string is None:
-#            raise SimpleFitsException("Must specify a fits file or a string containing a fits images.")
 
-        if fits_name is not None:
-            with open(fits_name, "rb") as fp:
-                fits_string = fp.read()
+def writeAtomic(fits_name, pieces):
+    """
+    Write to a temporary file in the same directory and then rename it,
+    so that the file is never seen partly written. pieces is an iterable
+    of lists of buffers, each list is written with a single call.
+    """
+    [fd, temp_name] = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(fits_name)),
+                                       prefix = "." + os.path.basename(fits_name) + ".",
+                                       suffix = ".tmp")
+    try:
+        try:
+            for buffers in pieces:
+                writeBuffers(fd, buffers)
 
-        # Read out keywords:
-        nkw = 0
-        while True:
+            # Otherwise after a crash the rename can be on disk before
+            # the data, leaving an empty or partial file.
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-            record = fits_string[nkw*80:(nkw+1)*80]
-            nkw += 1
-            if verbose:
-                print(record)
+        # mkstemp() files are only readable by us.
+        os.chmod(temp_name, 0o666 & ~UMASK)
 
-            if record.startswith(b'END'):
-                break
+        os.replace(temp_name, fits_name)
+
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except OSError:
+            pass
+        raise
+
+
+def writeBuffers(fd, buffers):
+    """
+    Write a list of buffers with os.writev(), or os.write() if there
+    is no writev(). These can both write less than we asked for.
+    """
+    buffers = [memoryview(x).cast("B") for x in buffers if len(x)]
+    while buffers:
+        if hasattr(os, "writev"):
+            n_bytes = os.writev(fd, buffers)
+        else:
+            n_bytes = os.write(fd, buffers[0])
 
-            if record.startswith(b'COMMENT'):
-                continue
+        while (n_bytes > 0):
+            if (n_bytes >= len(buffers[0])):
+                n_bytes -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][n_bytes:]
+                n_bytes = 0
 
-            if (b'/' in record):
-                record = record.split(b'/')[0]
 
-            [keyword, value] = record.split(b'=')
-            keyword = str(keyword.strip(), 'ascii')
-            value = str(value.strip(), 'ascii')
-            self.keywords[keyword] = parseValue(value)
+def writeFits(fits_name, np_data, keywords = None, chunk_size = 2**22):
+    """
+    Write a numpy array as a FITS image, see makeHeader() for keywords.
 
-        header_bytes = nkw*80
+    Big endian signed data (such as FitsImage.np_data) is written as is,
+    other data is converted chunk_size bytes at a time. Unsigned integers
+    are written with the usual BZERO convention.
+    """
+    header = makeHeader(np_data, keywords)
+    padding = b'\0' * (-(np_data.size * np_data.dtype.itemsize) % BLOCK_SIZE)
 
-        # Find the start of the data (a multiple of 2880).
-        data_start = 2880
-        while (data_start < header_bytes):
-            data_start += 2880
+    def pieces():
+        buffers = [header]
+        for data in imageBuffers(np_data, chunk_size = chunk_size):
+            buffers.append(data)
+            yield buffers
+            buffers = []
+        yield buffers + [padding]
 
-        # Check that this is not a color image.
-        if ("NAXIS3" in self.keywords):
-            raise SimpleFitsException("RGB image detected. Image type not set to 'RAW'?")
-            
-        # Determine image size.
-        if ("NAXIS1" in self.keywords) and ("NAXIS2" in self.keywords):
+    writeAtomic(fits_name, pieces())
 
-            size1 = self.keywords["NAXIS1"]
-            size2 = self.keywords["NAXIS2"]
-            
-            # Handle 16bit images.
-            if (self.keywords["BITPIX"] == 16):
-                if verbose:
-                    print(size1, "x", size2, "- 16 bit image")
 
-                # Calculate image size.
-                image_size = size1 * size2 * 2
+def writeRaw(fits_name, fits_string):
+    """
+    Write FITS data (such as a BLOB) to a file unchanged.
+    """
+    writeAtomic(fits_name, [[fits_string]])
 
-                # Create image.
-                self.np_data = numpy.frombuffer(fits_string[data_start:data_start+image_size],
-                                                dtype = numpy.dtype('>i2'))
-                self.np_data = numpy.reshape(self.np_data, ((size2, size1)))
 
-                return
+class FitsHeader(object):
+    """
+    A FITS header. The header is parsed a (2880 byte) block at a time,
+    this only indexes the cards by keyword. The value and comment of a
+    keyword are parsed the first time that they are needed.
 
-        raise SimpleFitsException("Unrecognized FITS file type")
+    This behaves like a (read only) dictionary of keyword values.
+    """
+    def __init__(self, verbose = False, **kwds):
+        """
+        verbose - Print each card as it is parsed.
+        """
+        super().__init__(**kwds)
+        self.cards = {}
+        self.commentary = {}
+        self.complete = False
+        self.n_blocks = 0
+        self.parsed = {}
+        self.verbose = verbose
+
+    def __contains__(self, keyword):
+        return toKey(keyword) in self.cards
+
+    def __getitem__(self, keyword):
+        return self.getValue(keyword)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.cards)
+
+    def addBlock(self, block):
+        """
+        Index the keywords in a 2880 byte block. Returns True if this
+        block contained the END card, i.e. the header is complete.
+        """
+        if (len(block) != BLOCK_SIZE):
+            raise SimpleFitsException("Truncated FITS header, " + str(len(block)) + " bytes in the last block.")
+        if self.complete:
+            raise SimpleFitsException("FITS header is already complete.")
+
+        self.n_blocks += 1
+
+        # Only look at the cards before END, the rest is padding.
+        block = bytes(block)
+        end = BLOCK_SIZE
+        index = block.find(b'END')
+        while (index != -1):
+            if ((index % CARD_SIZE) == 0) and (block[index:index + 8] == END_KEYWORD):
+                end = index
+                self.complete = True
+                break
+            index = block.find(b'END', index + 1)
+
+        cards = numpy.frombuffer(block, dtype = "S80", count = end // CARD_SIZE).tolist()
+        if self.verbose:
+            for card in cards:
+                print(card)
+            if self.complete:
+                print(END_KEYWORD)
+
+        # Index the cards with values, the keyword is the (space padded)
+        # first 8 bytes of the card.
+        index = {card[:8] : card for card in cards if (card[8:10] == b'= ') and not (card[:8] in COMMENTARY_KEYWORDS)}
+        self.cards.update(index)
+
+        # HIERARCH keywords and commentary cards, or repeated keywords
+        # in which case the last one wins.
+        if (len(index) < len(cards)):
+            for card in cards:
+                if (card[8:10] == b'= ') and not (card[:8] in COMMENTARY_KEYWORDS):
+                    self.cards[card[:8]] = card
+                elif card.startswith(b'HIERARCH') and (b'=' in card):
+                    self.cards[card[9:card.index(b'=')].strip().ljust(8)] = card
+                elif card.strip():
+                    keyword = str(card[:8], "ascii").rstrip()
+                    self.commentary.setdefault(keyword, []).append(str(card[8:], "ascii").rstrip())
+
+        # A keyword may have been redefined.
+        self.parsed.clear()
+        return self.complete
+
+    def get(self, keyword, default = None):
+        if keyword in self:
+            return self.getValue(keyword)
+        return default
+
+    def getCard(self, keyword):
+        """
+        Returns the (80 byte) card for this keyword.
+        """
+        return self.cards[toKey(keyword)]
+
+    def getComment(self, keyword):
+        """
+        Returns the comment for this keyword, None if there isn't one.
+        """
+        return self.parseCard(keyword)[1]
+
+    def getCommentary(self, keyword = "COMMENT"):
+        """
+        Returns a list of the text of the COMMENT (or HISTORY, etc.) cards.
+        """
+        return self.commentary.get(keyword, [])
+
+    def getCommentaryCards(self):
+        """
+        Returns the (80 byte) COMMENT, HISTORY, etc. cards.
+        """
+        cards = []
+        for keyword in self.commentary:
+            for text in self.commentary[keyword]:
+                cards.append((keyword.ljust(8) + text).ljust(CARD_SIZE).encode("ascii"))
+        return cards
+
+    def getHeaderSize(self):
+        """
+        The size of the header in bytes, the data starts after this.
+        """
+        return self.n_blocks * BLOCK_SIZE
+
+    def getValue(self, keyword):
+        return self.parseCard(keyword)[0]
+
+    def isComplete(self):
+        return self.complete
+
+    def items(self):
+        return [(x, self.getValue(x)) for x in self.keys()]
+
+    def keys(self):
+        return [str(x, "ascii").rstrip() for x in self.cards]
+
+    def parseCard(self, keyword):
+        """
+        Returns [value, comment] for a keyword, these are cached.
+        """
+        try:
+            return self.parsed[keyword]
+        except KeyError:
+            pass
+
+        card = self.cards[toKey(keyword)]
+        start = 10
+        if card.startswith(b'HIERARCH'):
+            start = card.index(b'=') + 1
+        parsed = parseValueField(str(card[start:], "ascii"))
+        self.parsed[keyword] = parsed
+        return parsed
+
+    def values(self):
+        return [self.getValue(x) for x in self.keys()]
+
+        
+class FitsImage(object):
+
+    def __init__(self, fits_name = None, fits_string = None, memmap = False, native = False, verbose = False):
+        """
+        The image is a (read only) big endian view of fits_string, so no
+        copy of the data is made.
+
+        memmap - Only read the header of fits_name, the image is then a
+            (read only) numpy.memmap of the file. Slices of it, or regions
+            from getImage(), only read the pages of the file that they need.
+
+        native - Convert the image to native byte order. This is done in
+            place if fits_string is writable (a bytearray for example, or
+            a file that is not memory mapped), otherwise a copy is made.
+        """
+        self.fits_data = None
+        self.images = {}
+        self.keywords = FitsHeader(verbose = verbose)
+        self.np_data = None
+        self.owns_data = False
+        self.scaled = False
+
+#        if fits_name is None and fits_string is None:
+#            raise SimpleFitsException("Must specify a fits file or a string containing a fits images.")
+
+        if memmap:
+            if fits_name is None:
+                raise SimpleFitsException("Memory mapping requires a fits file.")
+
+            # Read out keywords, a block at a time.
+            with open(fits_name, "rb") as fp:
+                while not self.keywords.addBlock(fp.read(BLOCK_SIZE)):
+                    pass
+                file_size = os.fstat(fp.fileno()).st_size
+
+        else:
+            # Read into a bytearray so that the image is writable.
+            if fits_name is not None:
+                with open(fits_name, "rb") as fp:
+                    fits_string = bytearray(os.fstat(fp.fileno()).st_size)
+                    fits_string = fits_string[:fp.readinto(fits_string)]
+                    self.owns_data = True
+
+            # Read out keywords, a block at a time.
+            fits_view = memoryview(fits_string)
+            offset = 0
+            while not self.keywords.addBlock(fits_view[offset:offset + BLOCK_SIZE]):
+                offset += BLOCK_SIZE
+            file_size = len(fits_view)
+
+        # The data starts after the last header block.
+        data_start = self.keywords.getHeaderSize()
+
+        if not (self.keywords.get("BITPIX") in BITPIX_TYPES) or not self.keywords.get("NAXIS"):
+            raise SimpleFitsException("Unrecognized FITS file type")
+
+        # Determine image size, the first axis varies fastest.
+        dtype = BITPIX_TYPES[self.keywords["BITPIX"]]
+        shape = tuple([self.keywords["NAXIS" + str(i)] for i in range(self.keywords["NAXIS"], 0, -1)])
+        n_pixels = 1
+        for size in shape:
+            n_pixels *= size
+
+        if verbose:
+            print(" x ".join([str(x) for x in reversed(shape)]), "-", self.keywords["BITPIX"], "bit image")
+
+        if ((file_size - data_start) < (n_pixels * dtype.itemsize)):
+            raise SimpleFitsException("Truncated FITS data, expected " + str(n_pixels * dtype.itemsize) + " bytes.")
+
+        # Create image.
+        if memmap:
+            self.np_data = numpy.memmap(fits_name, dtype = dtype, mode = "r", offset = data_start, shape = shape)
+        else:
+            self.np_data = numpy.frombuffer(fits_view, dtype = dtype, count = n_pixels, offset = data_start).reshape(shape)
+            self.fits_data = fits_view
+
+        if native:
+            self.toNative()
 
     def hasKeyword(self, keyword):
         return keyword in self.keywords
@@ -107,11 +570,139 @@ class FitsImage(object):
     def getKeywords(self):
         return self.keywords
 
-    def getImage(self):
-        if ("BZERO" in self.keywords):
-            return self.np_data + self.keywords["BZERO"]
+    def getImage(self, dtype = None, out = None, copy = False, region = None):
+        """
+        Returns the image with BSCALE and BZERO applied.
+
+        The unsigned integer conventions (BITPIX 16 with BZERO 32768, etc.)
+        are a flip of the sign bit, the result is then an unsigned integer
+        image. Otherwise if there is a BSCALE or BZERO the result is floating
+        point, and if there isn't the result is the data.
+
+        dtype - The data type of the result, this defaults to the type
+            described above.
+
+        out - Put the result in this array, its data type is used.
+
+        copy - Always return a new array. If this is False the result is
+            cached, and may be a (big endian) view of the data. If the data
+            was read from fits_name (so it isn't the caller's buffer) the
+            sign bit flip is also done in place, in which case np_data
+            becomes the unsigned image.
+
+        region - Only return this part of the image, a tuple of slices
+            such as numpy.s_[100:200, 300:400]. This is not cached. With
+            a memory mapped file only the region is read.
+        """
+        raw = self.np_data
+        if region is not None:
+            raw = raw[region]
+        bitpix = self.keywords["BITPIX"]
+        bscale = self.keywords.get("BSCALE", 1)
+        bzero = self.keywords.get("BZERO", 0)
+
+        # The data type of the physical values.
+        flip = None
+        physical = self.scaled or ((bscale == 1) and (bzero == 0))
+        if physical:
+            natural = raw.dtype.newbyteorder("=")
+        elif (bscale == 1) and (bitpix in UNSIGNED_CONVENTIONS) and (bzero == UNSIGNED_CONVENTIONS[bitpix][0]):
+            natural = flip = UNSIGNED_CONVENTIONS[bitpix][1]
+            unsigned_type = numpy.dtype("u" + str(flip.itemsize))
+            sign_bit = unsigned_type.type(1 << (8 * flip.itemsize - 1))
+        elif bitpix in [8, 16, -32]:
+            natural = numpy.dtype(numpy.float32)
+        else:
+            natural = numpy.dtype(numpy.float64)
+
+        if out is not None:
+            dtype = out.dtype
+        elif dtype is None:
+            dtype = natural
+        dtype = numpy.dtype(dtype)
+
+        view = (out is None) and not copy
+        cache = view and (region is None)
+        if cache and (dtype in self.images):
+            return self.images[dtype]
+
+        # Flip the sign bit in place, the data are then the physical values.
+        if cache and (flip is not None) and (flip == dtype) and self.owns_data and raw.flags.writeable:
+            unsigned = raw.view(unsigned_type.newbyteorder(raw.dtype.byteorder))
+            unsigned ^= sign_bit
+            self.np_data = raw = unsigned.view(flip.newbyteorder(raw.dtype.byteorder))
+            self.fits_data = None
+            self.images = {}
+            self.scaled = physical = True
+
+        # No conversion needed, so no copy needed.
+        if physical and view and (dtype.newbyteorder("=") == raw.dtype.newbyteorder("=")):
+            if cache:
+                self.images[dtype] = raw
+            return raw
+
+        if out is None:
+            out = numpy.empty(raw.shape, dtype = dtype)
+
+        if physical:
+            numpy.copyto(out, raw, casting = "unsafe")
+
+        elif (flip is not None) and (dtype.newbyteorder("=") == flip):
+            numpy.bitwise_xor(raw.view(unsigned_type.newbyteorder(raw.dtype.byteorder)),
+                              sign_bit,
+                              out = out.view(unsigned_type.newbyteorder(dtype.byteorder)))
+
+        # Flip first, adding BZERO in the result type can lose the low bits
+        # (in float64 every BITPIX 64 value near -2**63 becomes 0).
+        elif (flip is not None):
+            numpy.copyto(out,
+                         numpy.bitwise_xor(raw.view(unsigned_type.newbyteorder(raw.dtype.byteorder)), sign_bit),
+                         casting = "unsafe")
+
+        # These are done in the result type, without a temporary.
+        elif (dtype.kind == "f") or ((bscale == 1) and float(bzero).is_integer()):
+            if (bscale != 1):
+                numpy.multiply(raw, dtype.type(bscale), out = out, casting = "unsafe")
+                numpy.add(out, dtype.type(bzero), out = out, casting = "unsafe")
+            else:
+                numpy.add(raw, dtype.type(bzero), out = out, casting = "unsafe")
+
+        else:
+            out[...] = raw * bscale + bzero
+
+        if cache:
+            self.images[dtype] = out
+        return out
+
+    def toNative(self):
+        """
+        Convert the image to native byte order, in place if the image
+        is writable.
+        """
+        if self.np_data.dtype.isnative:
+            return
+
+        # The cached images may be views of the data.
+        self.images = {}
+
+        native_dtype = self.np_data.dtype.newbyteorder("=")
+        if self.np_data.flags.writeable:
+            self.np_data.byteswap(inplace = True)
+            self.np_data = self.np_data.view(native_dtype)
+            self.fits_data = None
+        else:
+            self.np_data = self.np_data.astype(native_dtype)
+            self.owns_data = True
+
+    def write(self, fits_name):
+        """
+        Write the image to a FITS file. This is the original FITS data if
+        we still have it unchanged, otherwise the image and keywords.
+        """
+        if self.fits_data is not None:
+            writeRaw(fits_name, self.fits_data)
         else:
-            return self.np_data
+            writeFits(fits_name, self.getImage(), keywords = self.keywords)
 
 
 if (__name__ == "__main__"):
@@ -122,10 +713,12 @@ if (__name__ == "__main__"):
 
     parser.add_argument('--fits_file', dest='fits_file', type=str, required=True,
                         help = "The name of the fits file to load.")
+    parser.add_argument('--memmap', dest='memmap', action='store_true',
+                        help = "Memory map the file instead of reading it.")
 
     args = parser.parse_args()
 
-    fi = FitsImage(fits_name = args.fits_file)
+    fi = FitsImage(fits_name = args.fits_file, memmap = args.memmap)
     print("This file has the following keywords:")
     for key in fi.getKeywords():
         print(" ", key, fi.getKeyword(key))